@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+import sys, os
+import io
+import re
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import itertools
+from string import Template
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import MeshCache
+from csgxml import parse_csg_graph, add_build_arguments, separation_from_args, tessellation_from_args,\
+                   profiler_from_args, report_profile, prepare_export, export_from_args, save_result
+from profiler import Profiler
+
+# Meshes of the solids built by this process, shared by all the jobs it runs
+primitives = {}
+# The primitives are dropped once there are more of them than this
+MAX_PRIMITIVES = 1024
+# The caches of this process by directory, kept between its jobs so their size is only counted once
+caches = {}
+
+'''
+Parses the parameter grid of a template.
+
+@param params: strings 'name=value1,value2,...'
+@return: list of (name, [values])
+'''
+def parse_params(params):
+    grid = []
+    for param in params:
+        if '=' not in param:
+            raise Exception("Parameter '{}' is not of the form name=value1,value2,...".format(param))
+        name, values = param.split('=', 1)
+        grid.append((name.strip(), [value.strip() for value in values.split(',')]))
+    return grid
+
+# Replaces the characters of a parameter value which can not be in a file name
+def file_name_part(text):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', text)
+
+# Describes what a job builds, for error messages
+def job_source(job):
+    if job['text'] is None:
+        return "'{}'".format(job['file'])
+    return ', '.join('{}={}'.format(k, v) for k, v in job['params'].items())
+
+'''
+The jobs of a batch: one per xml file, or one per point of the parameter grid
+when a template is given. The placeholders of a template are written as
+$name or ${name}. Jobs are named after their file (and parameter values), no
+two jobs may get the same name as they would write the same output file.
+
+@param files: xml files (or a single template)
+@param grid: list of (name, [values]), empty for plain xml files
+@param output_dir: Directory of the output files, None to not write any
+@param extension: Extension of the output files: '.stl' or '.xmesh' (binary mesh files)
+@return: list of jobs, dicts with the name of the job, the xml file or text and the output file
+'''
+def make_jobs(files, grid, output_dir, extension='.stl'):
+    jobs = []
+    if not grid:
+        for fname in files:
+            name = os.path.splitext(os.path.basename(fname))[0]
+            jobs.append({'name': name, 'file': fname, 'text': None})
+    else:
+        if len(files) != 1:
+            raise Exception("A parameter grid needs exactly one template")
+        with open(files[0]) as fh:
+            template = Template(fh.read())
+        stem = os.path.splitext(os.path.basename(files[0]))[0]
+        names = [name for name, _ in grid]
+        for values in itertools.product(*[values for _, values in grid]):
+            point = dict(zip(names, values))
+            name = '_'.join([stem] + ['{}-{}'.format(file_name_part(k), file_name_part(v))
+                                      for k, v in zip(names, values)])
+            jobs.append({'name': name, 'file': files[0], 'text': template.substitute(point),
+                         'params': point})
+    named = {}
+    for job in jobs:
+        if job['name'] in named:
+            raise Exception("Jobs {} and {} both have the name '{}'".format(
+                job_source(named[job['name']]), job_source(job), job['name']))
+        named[job['name']] = job
+        job['output'] = None if output_dir is None else os.path.join(output_dir, job['name'] + extension)
+    return jobs
+
+'''
+Builds a single job, this is run in the worker processes.
+Subtrees are shared between the jobs through the on-disk cache, primitives
+through the meshes kept by the process.
+
+@param export: Keyword arguments of prepare_export for the result (see export_from_args)
+@return: summary of the job: time, size of the mesh, error (None if it was built)
+         and the records of the nodes if it is profiled
+'''
+def build(job, cache_dir, cache_bytes, workers, separation, target, tessellation, profile=False,
+          export=None):
+    if len(primitives) > MAX_PRIMITIVES:
+        primitives.clear()
+    if cache_dir not in caches:
+        # The batch removed the stale entries
+        caches[cache_dir] = MeshCache(cache_dir, cache_bytes, remove_stale=False)
+    cache = caches[cache_dir]
+    hits = cache.hits
+    summary = {'name': job['name'], 'output': job['output'], 'params': job.get('params'),
+               'seconds': 0., 'vertices': 0, 'triangles': 0, 'cache_hits': 0, 'error': None}
+    profiler = Profiler() if profile else None
+    start = time.time()
+    try:
+        xml_file = job['file'] if job['text'] is None else io.StringIO(job['text'])
+        csg_graph, name = parse_csg_graph(xml_file, cache=cache, workers=workers, separation=separation,
+                                          keep=[], target=target, primitives=primitives,
+                                          tessellation=tessellation, profiler=profiler)
+        mesh = prepare_export(csg_graph[name], **(export or {}))
+        if job['output'] is not None:
+            save_result(job['output'], mesh)
+        summary['vertices'] = len(mesh.V)
+        summary['triangles'] = len(mesh.F)
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    summary['seconds'] = time.time() - start
+    summary['cache_hits'] = cache.hits - hits
+    if profiler is not None:
+        # Nodes are named after their job in the profile of the batch
+        for record in profiler.records:
+            record['name'] = '{}:{}'.format(job['name'], record['name'])
+        summary['profile'] = profiler.records
+    return summary
+
+def print_summary(summaries, wall_time):
+    width = max([len(s['name']) for s in summaries] + [3])
+    print('{:<{w}} {:>9} {:>10} {:>10}  {}'.format('job', 'seconds', 'triangles', 'cache hits', 'status', w=width))
+    for s in summaries:
+        status = 'ok' if s['error'] is None else s['error']
+        print('{:<{w}} {:>9.3f} {:>10} {:>10}  {}'.format(s['name'], s['seconds'], s['triangles'],
+                                                          s['cache_hits'], status, w=width))
+    failed = sum(s['error'] is not None for s in summaries)
+    print('{} jobs ({} failed), {:.3f}s in jobs, {:.3f}s wall time'.format(
+        len(summaries), failed, sum(s['seconds'] for s in summaries), wall_time))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build many csg xml files, or the variants of a template, as stl files')
+    parser.add_argument('files', nargs='+', help='csg xml files, or a single template with --param')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help='Values of a template parameter, every combination of the values is built')
+    parser.add_argument('-o', '--output-dir', help='Directory of the output files (none are written if not given)')
+    parser.add_argument('--format', choices=['stl', 'xmesh'], default='stl',
+                        help='Format of the output files, xmesh is the binary mesh format')
+    parser.add_argument('--target', help='Name of the solid to build (the last one if not given)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Number of processes building files')
+    parser.add_argument('--summary', metavar='FILE', help='Write the summary of the batch as json to FILE')
+    add_build_arguments(parser)
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.files, parse_params(args.param), args.output_dir, '.' + args.format)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    # Subtrees are shared through a cache, a temporary one if none is given
+    cache_dir = args.cache if args.cache is not None else tempfile.mkdtemp(prefix='pyxcsg-')
+    cache_bytes = int(args.cache_size * 2**20)
+    # Removes the entries of earlier versions of the cache, once for all jobs
+    MeshCache(cache_dir, cache_bytes)
+
+    profiler = profiler_from_args(args)
+    start = time.time()
+    summaries = [None] * len(jobs)
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(build, job, cache_dir, cache_bytes, args.workers,
+                                   separation_from_args(args), args.target,
+                                   tessellation_from_args(args), profiler is not None,
+                                   export_from_args(args)): i
+                       for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                summary = future.result()
+                summaries[futures[future]] = summary
+                print('{} ({:.3f}s)'.format(summary['name'], summary['seconds']), file=sys.stderr)
+    finally:
+        if args.cache is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    wall_time = time.time() - start
+
+    print_summary(summaries, wall_time)
+    if profiler is not None:
+        for summary in summaries:
+            profiler.records.extend(summary.pop('profile', []))
+        report_profile(profiler, args)
+    if args.summary is not None:
+        with open(args.summary, 'w') as fh:
+            json.dump({'wall_time': wall_time, 'jobs': summaries}, fh, indent=2)
+    if any(s['error'] is not None for s in summaries):
+        sys.exit(1)
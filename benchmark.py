@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import statistics
+import xml.etree.ElementTree as ET
+import numpy as np
+import factory
+from factory import make_cuboid, make_cylinder, make_sphere
+from mesh import Mesh
+from decimate import decimate
+from utils import save_to_stl, apply_transform, rotation_matrix
+from synthetic import make_design
+import signed_distance_factory as sdf
+
+# Benchmarks are grouped, every group yields (name, params, function) cases.
+# 'quick' selects smaller sizes, for a fast check.
+
+def clear_templates():
+    factory.templates.clear()
+    factory.sphere_errors.clear()
+
+def primitive_cases(quick):
+    for refining in range(5 if quick else 7):
+        yield 'make_sphere', {'refining': refining}, lambda r=refining: make_sphere([0, 0, 0], 1.0, r)
+        # Without the memoized templates
+        yield 'make_sphere_cold', {'refining': refining}, \
+              lambda r=refining: (clear_templates(), make_sphere([0, 0, 0], 1.0, r))
+    for refining in range(4 if quick else 6):
+        yield 'make_cuboid', {'refining': refining}, lambda r=refining: make_cuboid([1, 2, 3], refining=r)
+    for resolution in ([8, 64] if quick else [8, 64, 512, 4096]):
+        yield 'make_cylinder', {'resolution': resolution}, \
+              lambda n=resolution: make_cylinder([0, 0, 0], [1, 2, 3], 0.5, n)
+
+def transform_cases(quick):
+    for refining in ([3, 5] if quick else [3, 5, 7]):
+        mesh = Mesh(*make_sphere([0, 0, 0], 1.0, refining))
+        M = rotation_matrix(0, 0.3, (1., 2., 3.))
+        yield 'apply_transform', {'vertices': len(mesh.V)}, lambda V=mesh.V: apply_transform(V, M)
+        yield 'Mesh.transformed', {'vertices': len(mesh.V)}, lambda mesh=mesh: mesh.transformed(M)
+        # Every vertex twice, as after concatenating a mesh with itself
+        doubled = Mesh(np.vstack([mesh.V, mesh.V]), np.vstack([mesh.F, mesh.F + len(mesh.V)]))
+        yield 'Mesh.welded', {'vertices': len(doubled.V)}, lambda mesh=doubled: mesh.welded()
+
+def decimate_cases(quick):
+    for refining in ([4, 5] if quick else [4, 5, 6]):
+        mesh = Mesh(*make_sphere([0, 0, 0], 1.0, refining))
+        yield 'decimate', {'faces': len(mesh.F), 'max_faces': len(mesh.F) // 10}, \
+              lambda mesh=mesh: decimate(mesh, max_faces=len(mesh.F) // 10)
+
+def stl_cases(quick):
+    for refining in ([3, 5] if quick else [3, 5, 7]):
+        V, F = make_sphere([0, 0, 0], 1.0, refining)
+        yield 'save_to_stl', {'faces': len(F)}, lambda V=V, F=F: save_to_stl(io.BytesIO(), V, F)
+
+def csg_cases(quick):
+    # The boolean operations need libigl
+    from csgxml import parse_csg_graph
+    # A sphere moved by 20 unary operations
+    ops = ['<unary_op name="m" type="translate"><operand>m</operand><distance>[0.1, 0.2, 0.3]</distance></unary_op>',
+           '<unary_op name="m" type="rotateX"><operand>m</operand><rotation>10</rotation></unary_op>',
+           '<unary_op name="m" type="scale"><operand>m</operand><scale>[1.01, 1, 0.99]</scale></unary_op>']
+    chain = ''.join(['<data><solid name="m" shape="sphere"><center>[0, 0, 0]</center>',
+                     '<refining>5</refining></solid>'] + [ops[i % 3] for i in range(20)] + ['</data>'])
+    yield 'unary_chain', {'ops': 20}, lambda: parse_csg_graph(io.StringIO(chain))[0]['m']
+    sizes = [(2, 1), (8, 1)] if quick else [(2, 1), (8, 1), (8, 2), (27, 2)]
+    for parts, depth in sizes:
+        for spacing in [1.5, 3.0]:
+            design = ET.tostring(make_design(parts, depth, spacing=spacing), encoding='unicode')
+            yield 'design', {'parts': parts, 'depth': depth, 'spacing': spacing}, \
+                  lambda design=design: parse_csg_graph(io.StringIO(design))
+
+def sdf_cases(quick):
+    for n in ([32, 64] if quick else [32, 64, 128, 192]):
+        def grid(phi, band=None, n=n, workers=1):
+            G = sdf.Grid([-10., -10., -10.], [10., 10., 10.], n, n, n, band=band)
+            G.create(phi, workers=workers)
+            return G
+        phi = sdf.sphere(5.0)
+        yield 'Grid.create', {'nodes': n, 'phi': 'sphere'}, lambda: grid(phi)
+        if os.cpu_count() > 1:
+            yield 'Grid.create_parallel', {'nodes': n, 'phi': 'sphere', 'workers': os.cpu_count()}, \
+                  lambda: grid(phi, workers=os.cpu_count())
+        yield 'Grid.create_narrow_band', {'nodes': n, 'phi': 'sphere'}, lambda: grid(phi, band=1.0)
+        A = sdf.Grid([-10., -10., -10.], [10., 10., 10.], n, n, n, phi=sdf.box(8., 6., 4.))
+        B = sdf.Grid([-10., -10., -10.], [10., 10., 10.], n, n, n, phi=sdf.sphere(4.))
+        C = sdf.Grid([-10., -10., -10.], [10., 10., 10.], n, n, n, phi=sdf.cylinder(8., 1.5))
+        for op in ['union', 'intersection', 'difference']:
+            tree = getattr(sdf, op)(sdf.rotate(getattr(sdf, op)(A, B), np.eye(3)), C)
+            yield 'sdf_' + op, {'nodes': n}, lambda tree=tree: grid(tree.phi)
+
+groups = {'primitives': primitive_cases,
+          'transforms': transform_cases,
+          'decimate': decimate_cases,
+          'stl': stl_cases,
+          'csg': csg_cases,
+          'sdf': sdf_cases}
+
+'''
+Times a function.
+
+@param function: The function to time
+@param repeat: Number of timed runs (after one untimed warm up run)
+@return: min, median and mean of the run times in seconds
+'''
+def time_function(function, repeat):
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times), statistics.mean(times)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+'''
+Runs the benchmarks of the given groups.
+
+@return: the results: metadata of the run and one entry per case
+'''
+def run(names, repeat=5, quick=False):
+    results = []
+    for group in names:
+        try:
+            for name, params, function in groups[group](quick):
+                best, median, mean = time_function(function, repeat)
+                results.append({'group': group, 'name': name, 'params': params, 'repeat': repeat,
+                                'min': best, 'median': median, 'mean': mean})
+                print('{:<12} {:<24} {:<44} {:10.6f}s'.format(group, name, json.dumps(params), best),
+                      file=sys.stderr)
+        except ImportError as e:
+            results.append({'group': group, 'skipped': str(e)})
+            print('{:<12} skipped: {}'.format(group, e), file=sys.stderr)
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'quick': quick}
+    return {'meta': meta, 'results': results}
+
+# Identifies a case across runs
+def case_key(result):
+    return result['group'], result['name'], json.dumps(result['params'], sort_keys=True)
+
+'''
+Compares the minimum times of a run with a baseline run.
+
+@return: the cases which are more than 'threshold' times slower, as (key, baseline, current)
+'''
+def regressions(baseline, current, threshold=1.2):
+    before = {case_key(r): r['min'] for r in baseline['results'] if 'skipped' not in r}
+    slower = []
+    for r in current['results']:
+        if 'skipped' in r or case_key(r) not in before:
+            continue
+        if r['min'] > threshold * before[case_key(r)]:
+            slower.append((case_key(r), before[case_key(r)], r['min']))
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pyXCSG')
+    parser.add_argument('--groups', nargs='+', choices=list(groups), default=list(groups))
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of every case')
+    parser.add_argument('--quick', action='store_true', help='Only the smaller sizes')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the results as json to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='Baseline results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Cases this many times slower than the baseline are regressions')
+    args = parser.parse_args()
+
+    results = run(args.groups, args.repeat, args.quick)
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare is not None:
+        with open(args.compare) as fh:
+            slower = regressions(json.load(fh), results, args.threshold)
+        for (group, name, params), before, now in slower:
+            print('Regression {} {} {}: {:.6f}s -> {:.6f}s'.format(group, name, params, before, now),
+                  file=sys.stderr)
+        if slower:
+            sys.exit(1)
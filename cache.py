@@ -0,0 +1,180 @@
+import os
+import hashlib
+from collections import OrderedDict
+from meshfile import save_mesh, load_mesh, EXTENSION
+
+# Bump when the meaning of a cached mesh changes, so old entries are not reused
+CACHE_VERSION = 1
+# Extensions of the entries of earlier versions of the cache, which are deleted
+STALE_EXTENSIONS = ('.npz',)
+# Fraction of max_bytes left free by an eviction, so a full cache is not scanned on every put
+EVICTION_HEADROOM = 0.1
+
+'''
+Content hash of a csg node: its tag, type/shape, parameters and the hashes
+of its operands. The name of the node does not take part, so renaming a
+node keeps its cached result.
+
+@param element: The xml element of the node
+@param operand_hashes: The hashes of the operands of the node (in order)
+@param options: Settings changing the result of the node which are not
+                part of the element (like the tessellation of a solid)
+@return: hex digest identifying the node's result
+'''
+def node_hash(element, operand_hashes=(), options=''):
+    h = hashlib.sha256()
+    h.update('v{}|{}'.format(CACHE_VERSION, element.tag).encode())
+    for key, value in sorted(element.attrib.items()):
+        if key != 'name':
+            h.update('|{}={}'.format(key, value).encode())
+    for child in element:
+        if child.tag != 'operand':
+            text = ' '.join((child.text or '').split())
+            h.update('|{}:{}'.format(child.tag, text).encode())
+    for operand_hash in operand_hashes:
+        h.update('|operand:{}'.format(operand_hash).encode())
+    if options:
+        h.update('|options:{}'.format(options).encode())
+    return h.hexdigest()
+
+'''
+On-disk cache of meshes keyed by node hashes.
+Entries are binary mesh files (see meshfile), which are memory mapped when
+read. Reading an entry refreshes its modification time, and the least
+recently used entries are deleted once the cache grows beyond max_bytes.
+The size of the cache is counted as it grows, and the directory is only
+scanned again once the count goes over max_bytes.
+Entries in the formats of earlier versions can not be read anymore and are
+deleted when the cache is opened, unless remove_stale is False (like for the
+caches of the jobs of a batch, where the batch removes them once). Several
+processes may share a cache, so an entry may be deleted by another one at
+any time, and entries written by the others are only counted by a scan.
+'''
+class MeshCache:
+    def __init__(self, directory, max_bytes=1 << 30, remove_stale=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Bytes in the cache as of the last scan and the entries put since, None before the first scan
+        self.bytes = None
+        os.makedirs(directory, exist_ok=True)
+        if remove_stale:
+            self.remove_stale()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    '''
+    @param key: node hash
+    @return: the cached Mesh, or None if not cached
+    '''
+    def get(self, key):
+        path = self.path(key)
+        try:
+            mesh = load_mesh(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Mark as recently used
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            # Evicted by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return mesh
+
+    def put(self, key, mesh):
+        # Atomic, so concurrent builds never see half written entries
+        path = self.path(key)
+        save_mesh(path, mesh)
+        if self.bytes is not None:
+            try:
+                self.bytes += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        if self.bytes is None or self.bytes > self.max_bytes:
+            self.evict()
+
+    # Deletes the entries of earlier versions (named by a node hash)
+    def remove_stale(self):
+        for entry in os.scandir(self.directory):
+            key, extension = os.path.splitext(entry.name)
+            if extension in STALE_EXTENSIONS and len(key) == 64 and \
+               all(c in '0123456789abcdef' for c in key):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    # Deletes the least recently used entries until the cache fits in max_bytes
+    # with some headroom
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(EXTENSION):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_bytes if total <= self.max_bytes else self.max_bytes * (1 - EVICTION_HEADROOM)
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.bytes = total
+
+'''
+In-memory cache of meshes keyed by node hashes, with the interface of
+MeshCache. It keeps the results of earlier builds of a design which is
+rebuilt over and over (like in watch mode), optionally in front of an
+on-disk MeshCache. The least recently used entries are dropped once the
+meshes take more than max_bytes.
+'''
+class MemoryCache:
+    def __init__(self, max_bytes=1 << 30, backing=None):
+        self.max_bytes = max_bytes
+        self.backing = backing
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        mesh = self.entries.get(key)
+        if mesh is not None:
+            # Mark as recently used
+            self.entries.move_to_end(key)
+        elif self.backing is not None:
+            mesh = self.backing.get(key)
+            if mesh is not None:
+                self.add(key, mesh)
+        if mesh is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return mesh
+
+    def put(self, key, mesh):
+        self.add(key, mesh)
+        if self.backing is not None:
+            self.backing.put(key, mesh)
+
+    def add(self, key, mesh):
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.bytes -= old.V.nbytes + old.F.nbytes
+        self.entries[key] = mesh
+        self.bytes += mesh.V.nbytes + mesh.F.nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.V.nbytes + old.F.nbytes
@@ -1,9 +1,18 @@
 #!/usr/bin/python3
 import xml.etree.ElementTree as ET
 import sys, os
+import argparse
 import numpy as np
-from factory import make_cuboid, make_cylinder, make_sphere, make_pyramid, make_prism
-from utils import save_to_stl, translate, rotateX, rotateY, rotateZ, scale, scaleRectangleXZ
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from cache import MeshCache, node_hash
+from mesh import Mesh, WELD_TOLERANCE
+from meshfile import save_mesh, is_mesh_file
+from decimate import decimate
+from profiler import Profiler, measure
+from factory import make_cuboid, make_cylinder, make_sphere, make_pyramid, make_prism, sphere_radius
+from utils import save_to_stl, scaleRectangleXZ, translation_matrix, rotation_matrix, scale_matrix,\
+                  apply_transform
 
 # Add pyigl to the path
 PATH_TO_LIBIGL = '/home/max/diku/2018/project2018b2/SoftRoboticDesign/robot_designs/libigl/python'
@@ -11,7 +20,54 @@ sys.path.insert(0, PATH_TO_LIBIGL)
 import pyigl as igl
 
 
-def parse_cuboid(element):
+# Tolerances are this many times coarser for previews
+PREVIEW_FACTOR = 10.0
+# Tolerance of previews of solids without one, relative to their size
+PREVIEW_RELATIVE_TOLERANCE = 0.02
+
+'''
+How the curved surfaces of the solids are tessellated.
+A solid is tessellated within its own <tolerance> (the chordal error in model
+units) if it has one, else within the global tolerance, else by its
+refining/resolution parameters. Previews are PREVIEW_FACTOR times coarser,
+solids without any tolerance use PREVIEW_RELATIVE_TOLERANCE times their size.
+'''
+class Tessellation:
+    def __init__(self, tolerance=None, preview=False):
+        if tolerance is not None and not tolerance > 0:
+            raise Exception("The tolerance must be positive, got {}".format(tolerance))
+        self.tolerance = tolerance
+        self.preview = preview
+
+    '''
+    @param element: The xml element of a solid
+    @param size: Radius (or size) of the solid
+    @return: the tolerance of the solid, None to use its refining/resolution
+    '''
+    def solid_tolerance(self, element, size):
+        tolerance = element.find('tolerance')
+        if tolerance is not None:
+            tolerance = float(tolerance.text)
+            if not tolerance > 0:
+                raise Exception("Solid '{}' needs a positive <tolerance>, got {}".format(
+                    element.attrib.get('name'), tolerance))
+        else:
+            tolerance = self.tolerance
+        if self.preview:
+            if tolerance is None:
+                return PREVIEW_RELATIVE_TOLERANCE * size
+            return PREVIEW_FACTOR * tolerance
+        return tolerance
+
+    # Identifies the tessellation in the hashes of the solids ('' for the default)
+    def key(self):
+        if self.tolerance is None and not self.preview:
+            return ''
+        return 'tolerance={}|preview={}'.format(self.tolerance, self.preview)
+
+DEFAULT_TESSELLATION = Tessellation()
+
+def parse_cuboid(element, tessellation=DEFAULT_TESSELLATION):
     # Size parameter (required)
     size = element.find('size').text
     size = list(map(float, size[size.find('[')+1:size.find(']')].split(',')))
@@ -30,10 +86,11 @@ def parse_cuboid(element):
         refining = int(refining.text)
     else:
         refining = 1
-    V, F = make_cuboid(size, center, scale, refining=refining)
-    return [igl.eigen.MatrixXd(V), igl.eigen.MatrixXi(F)]
+    tolerance = tessellation.solid_tolerance(element, max(size))
+    V, F = make_cuboid(size, center, scale, refining=refining, tolerance=tolerance)
+    return [Mesh(V, F), np.eye(4), None]
 
-def parse_cylinder(element):
+def parse_cylinder(element, tessellation=DEFAULT_TESSELLATION):
     # Start parameter (required)
     start = element.find('start').text
     start = list(map(float, start[start.find('[')+1:start.find(']')].split(',')))
@@ -48,10 +105,11 @@ def parse_cylinder(element):
     resolution = element.find('resolution')
     if not resolution is None:
         resolution = int(resolution.text)
-    V, F = make_cylinder(start, end, radius, resolution)
-    return [igl.eigen.MatrixXd(V), igl.eigen.MatrixXi(F)]
+    tolerance = tessellation.solid_tolerance(element, radius if radius is not None else 1.0)
+    V, F = make_cylinder(start, end, radius, resolution, tolerance=tolerance)
+    return [Mesh(V, F), np.eye(4), None]
 
-def parse_sphere(element):
+def parse_sphere(element, tessellation=DEFAULT_TESSELLATION):
     # Center parameter (required)
     center = element.find('center').text
     center = list(map(float, center[center.find('[')+1:center.find(']')].split(',')))
@@ -63,10 +121,11 @@ def parse_sphere(element):
     refine = element.find('refining')
     if not refine is None:
         refine = int(refine.text)
-    V, F = make_sphere(center, scale, refine)
-    return [igl.eigen.MatrixXd(V), igl.eigen.MatrixXi(F)]
+    tolerance = tessellation.solid_tolerance(element, sphere_radius(scale if scale is not None else 1.0))
+    V, F = make_sphere(center, scale, refine, tolerance=tolerance)
+    return [Mesh(V, F), np.eye(4), None]
 
-def parse_pyramid(element):
+def parse_pyramid(element, tessellation=DEFAULT_TESSELLATION):
     height = float(element.find('height').text)
     width = float(element.find('width').text)
     length = float(element.find('length').text)
@@ -80,9 +139,9 @@ def parse_pyramid(element):
     if not scale is None:
         scale = float(scale.text)
     V, F = make_pyramid(height, width, length, center, scale)
-    return [igl.eigen.MatrixXd(V), igl.eigen.MatrixXi(F)]
+    return [Mesh(V, F), np.eye(4), None]
 
-def parse_prism(element):
+def parse_prism(element, tessellation=DEFAULT_TESSELLATION):
     center = element.find('center')
     if not center is None:
         center = list(map(float, center.text[center.text.find('[')+1:center.text.find(']')].split(',')))
@@ -100,188 +159,620 @@ def parse_prism(element):
         angle = float(angle.text)
 
     V, F = make_prism(center, length, height, angle)
-    return [igl.eigen.MatrixXd(V), igl.eigen.MatrixXi(F)]
+    return [Mesh(V, F), np.eye(4), None]
+
 
+# Unary operations do not touch the vertices. They compose a 4x4 affine matrix
+# onto the pending transform of their operand, so a whole chain of transforms
+# is applied with a single matmul once the node is read (see CSGGraph).
 
 def parse_translation(element, csg_graph):
     # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
+    mesh, M, c = csg_graph.node(element.find('operand').text.strip())
     # Distance parameter (required)
     distance = element.find('distance').text
     distance = list(map(float, distance[distance.find('[')+1:distance.find(']')].split(',')))
-    # Translate and return the "new" vertices
-    return translate(V, distance), F
+    # Translate and return the "new" transform
+    return mesh, translation_matrix(distance) @ M, c
 
-def parse_rotationX(element, csg_graph):
+def parse_rotation(element, csg_graph, axis):
     # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
+    mesh, M, c = csg_graph.node(element.find('operand').text.strip())
     # Rotation parameter (required)
     rotation = float(element.find('rotation').text)
     # Transform the degrees into radians
     rotation = rotation * np.pi / 180.
-    # Translate and return the "new" vertices
-    return rotateX(V, rotation), F
+    # The rotation is about the center of the transformed vertices. The mean
+    # commutes with affine maps, so it is the transformed mean of the base vertices.
+    if c is None:
+        c = np.mean(mesh.V, axis=0)
+    center = apply_transform(c, M)
+    # Rotate and return the "new" transform
+    return mesh, rotation_matrix(axis, rotation, center) @ M, c
+
+def parse_rotationX(element, csg_graph):
+    return parse_rotation(element, csg_graph, 0)
 
 def parse_rotationY(element, csg_graph):
-    # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
-    # Rotation parameter (required)
-    rotation = float(element.find('rotation').text)
-    # Transform the degrees into radians
-    rotation = rotation * np.pi / 180.
-    # Translate and return the "new" vertices
-    return rotateY(V, rotation), F
+    return parse_rotation(element, csg_graph, 1)
 
 def parse_rotationZ(element, csg_graph):
-    # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
-    # Rotation parameter (required)
-    rotation = float(element.find('rotation').text)
-    # Transform the degrees into radians
-    rotation = rotation * np.pi / 180.
-    # Translate and return the "new" vertices
-    return rotateZ(V, rotation), F
+    return parse_rotation(element, csg_graph, 2)
 
 def parse_scale(element, csg_graph):
     # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
+    mesh, M, c = csg_graph.node(element.find('operand').text.strip())
     # Scale parameter (required)
     s = element.find('scale').text
     s = list(map(float, s[s.find('[')+1:s.find(']')].split(',')))
-    # Translate and return the "new" vertices
-    return scale(V, s), F
+    # Scale and return the "new" transform
+    return mesh, scale_matrix(s) @ M, c
 
 
 def parse_scale_rectangleXZ(element, csg_graph):
-    # Get the current csg object
-    V, F = csg_graph[element.find('operand').text.strip()]
+    # Scaling single vertices is not affine, so the operand is materialized first
+    mesh = csg_graph[element.find('operand').text.strip()]
     # Scale parameter (required)
     s = element.find('scale').text
     s = list(map(float, s[s.find('[')+1:s.find(']')].split(',')))
     # Translate and return the "new" vertices
-    return scaleRectangleXZ(V, s), F
-
+    return Mesh(scaleRectangleXZ(mesh.V, s), mesh.F), np.eye(4), None
 
-def parse_union(element, csg_graph):
-    # Placeholders for the new vertices and faces
-    V = igl.eigen.MatrixXd()
-    F = igl.eigen.MatrixXi()
-    # Get the operand names
-    operands = element.findall('operand')
-    operand_1 = operands[0].text.strip()
-    operand_2 = operands[1].text.strip()
-    # Perform the Union
-    V1, F1 = csg_graph[operand_1]
-    V2, F2 = csg_graph[operand_2]
 
-    igl.cgal.mesh_boolean(V1, F1, V2, F2, igl.MESH_BOOLEAN_TYPE_UNION, V, F)
+def parse_decimate(element, csg_graph):
+    mesh = csg_graph[element.find('operand').text.strip()]
+    # Face budget and quadric error bound (at least one of them)
+    faces = element.find('faces')
+    error = element.find('error')
+    if faces is None and error is None:
+        raise Exception("Decimation '{}' needs <faces> or <error>".format(element.attrib.get('name')))
+    max_faces = int(faces.text) if faces is not None else None
+    max_error = float(error.text) if error is not None else None
+    return decimate(mesh, max_faces, max_error), np.eye(4), None
 
-    return V,F
 
-def parse_intersection(element, csg_graph):
-    # Placeholders for the new vertices and faces
-    V = igl.eigen.MatrixXd()
-    F = igl.eigen.MatrixXi()
-    # Get the operand names
-    operands = element.findall('operand')
-    operand_1 = operands[0].text.strip()
-    operand_2 = operands[1].text.strip()
-    # Perform the Union
-    V1, F1 = csg_graph[operand_1]
-    V2, F2 = csg_graph[operand_2]
+# igl boolean type of every binary operation
+boolean_types = {'union': igl.MESH_BOOLEAN_TYPE_UNION,
+                 'intersection': igl.MESH_BOOLEAN_TYPE_INTERSECT,
+                 'difference': igl.MESH_BOOLEAN_TYPE_MINUS}
 
-    igl.cgal.mesh_boolean(V1, F1, V2, F2, igl.MESH_BOOLEAN_TYPE_INTERSECT, V, F)
+# Meshes are only converted to igl.eigen matrices at the boundary to libigl
+def to_igl(mesh):
+    return igl.eigen.MatrixXd(mesh.V), igl.eigen.MatrixXi(mesh.F)
 
-    return V,F
+def from_igl(V, F):
+    # A view of the eigen buffer where possible, Mesh only copies to fix the layout
+    return Mesh(np.asarray(V), np.asarray(F))
 
-def parse_difference(element, csg_graph):
+def mesh_boolean(A, B, op):
     # Placeholders for the new vertices and faces
     V = igl.eigen.MatrixXd()
     F = igl.eigen.MatrixXi()
-    # Get the operand names
-    operands = element.findall('operand')
-    operand_1 = operands[0].text.strip()
-    operand_2 = operands[1].text.strip()
-    # Perform the Union
-    V1, F1 = csg_graph[operand_1]
-    V2, F2 = csg_graph[operand_2]
-
-    igl.cgal.mesh_boolean(V1, F1, V2, F2, igl.MESH_BOOLEAN_TYPE_MINUS, V, F)
-
-    return V,F
-
-parse_shape = {'cube' : lambda e: parse_cuboid(e),
-               'cylinder': lambda e: parse_cylinder(e),
-               'sphere': lambda e: parse_sphere(e),
-               'prism': lambda e: parse_prism(e),
-               'pyramid': lambda e: parse_pyramid(e)}
+    igl.cgal.mesh_boolean(*to_igl(A), *to_igl(B), boolean_types[op], V, F)
+    return from_igl(V, F)
+
+# Entry point of the worker processes. Meshes are pickled as their np.arrays.
+def run_boolean(op, A, B):
+    return mesh_boolean(A, B, op)
+
+# The directions of a 26-DOP: coordinate axes, face and body diagonals.
+# Principal axes are arbitrary for symmetric meshes (like cubes), these are not.
+kdop_axes = np.array([[1,0,0],[0,1,0],[0,0,1],
+                      [1,1,0],[1,-1,0],[1,0,1],[1,0,-1],[0,1,1],[0,1,-1],
+                      [1,1,1],[1,1,-1],[1,-1,1],[-1,1,1]], dtype=np.float64)
+
+'''
+Tests whether two meshes are separated, in which case their boolean
+operation is trivial. The axis aligned bounding boxes are always tested, the
+'obb' test additionally projects both meshes onto the principal axes of both
+meshes (their oriented bounding boxes), the cross products of those and the
+13 directions of a 26-DOP. This is a separating axis test for the convex hulls
+on those axes. Touching meshes are not separated.
+
+@param A: The first mesh
+@param B: The second mesh
+@param separation: 'aabb', 'obb' or None (no test)
+@return: the test that separated the meshes ('aabb' or 'obb') or None
+'''
+def separating_test(A, B, separation='aabb'):
+    if separation is None:
+        return None
+    if A.is_empty() or B.is_empty():
+        return 'aabb'
+    (min1, max1), (min2, max2) = A.bounds, B.bounds
+    if np.any(min1 > max2) or np.any(min2 > max1):
+        return 'aabb'
+    if separation == 'obb':
+        V1, V2 = A.V, B.V
+        # Principal axes of both meshes and their pairwise cross products
+        A1 = np.linalg.eigh(np.cov(V1.T))[1].T
+        A2 = np.linalg.eigh(np.cov(V2.T))[1].T
+        C = np.cross(A1[:, None, :], A2[None, :, :]).reshape(-1, 3)
+        axes = np.vstack([A1, A2, C, kdop_axes])
+        lengths = np.linalg.norm(axes, axis=1)
+        axes = axes[lengths > 1e-9] / lengths[lengths > 1e-9, None]
+        P1 = V1 @ axes.T
+        P2 = V2 @ axes.T
+        if np.any(P1.min(axis=0) > P2.max(axis=0)) or np.any(P2.min(axis=0) > P1.max(axis=0)):
+            return 'obb'
+    return None
+
+'''
+Result of a boolean operation between two separated meshes:
+the union is both meshes, the intersection is empty and the difference is
+the first mesh unchanged.
+
+@return: the resulting mesh
+'''
+def separated_boolean(A, B, op):
+    if op == 'union':
+        return Mesh(np.vstack([A.V, B.V]), np.vstack([A.F, B.F + len(A.V)]))
+    if op == 'intersection':
+        return Mesh.empty()
+    return A
+
+parse_shape = {'cube' : lambda e, tessellation: parse_cuboid(e, tessellation),
+               'cylinder': lambda e, tessellation: parse_cylinder(e, tessellation),
+               'sphere': lambda e, tessellation: parse_sphere(e, tessellation),
+               'prism': lambda e, tessellation: parse_prism(e, tessellation),
+               'pyramid': lambda e, tessellation: parse_pyramid(e, tessellation)}
 
 parse_unaries = {'translate' : lambda e,csg_graph: parse_translation(e, csg_graph),
                  'rotateX' : lambda e,csg_graph: parse_rotationX(e, csg_graph),
                  'rotateY' : lambda e,csg_graph: parse_rotationY(e, csg_graph),
                  'rotateZ' : lambda e,csg_graph: parse_rotationZ(e, csg_graph),
                  'scale': lambda e, csg_graph: parse_scale(e, csg_graph),
-                 'scaleRectangleXZ': lambda e,csg_graph: parse_scale_rectangleXZ(e, csg_graph)}
-
-
-parse_operations = {'union' : lambda e,csg_graph: parse_union(e, csg_graph),
-                    'intersection' : lambda e,csg_graph: parse_intersection(e,csg_graph),
-                    'difference' : lambda e,csg_graph: parse_difference(e,csg_graph)}
-
-def parse_csg_graph(xml_file):
-    # Placeholder which will contain all nodes of the csg graph
-    csg_graph = {}
+                 'scaleRectangleXZ': lambda e,csg_graph: parse_scale_rectangleXZ(e, csg_graph),
+                 'decimate': lambda e, csg_graph: parse_decimate(e, csg_graph)}
+
+
+# The nodes of a csg graph are stored as [mesh, M, c]: the base Mesh, a
+# pending 4x4 affine transform M and the (cached) mean of the base vertices.
+# Reading a node applies M once and returns the Mesh (which unpacks as V, F).
+# 'paths' records how every binary operation was evaluated: 'cgal', 'cache'
+# or the separating test ('aabb'/'obb') that made it trivial.
+class CSGGraph(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.paths = {}
+
+    def __getitem__(self, name):
+        mesh, M, c = self.node(name)
+        if not np.array_equal(M, np.eye(4)):
+            mesh = mesh.transformed(M)
+            # Keep the materialized mesh, so it is only transformed once
+            self[name] = [mesh, np.eye(4), None]
+        return mesh
+
+    def node(self, name):
+        return dict.__getitem__(self, name)
+
+# A view of a csg graph under the names an element refers to. Names can be
+# re-bound later in the file, so nodes are stored by their index in the file.
+class CSGBindings:
+    def __init__(self, csg_graph, bindings):
+        self.csg_graph = csg_graph
+        self.bindings = bindings
+
+    def __getitem__(self, name):
+        return self.csg_graph[self.bindings[name]]
+
+    def node(self, name):
+        return self.csg_graph.node(self.bindings[name])
+
+# A node of the dependency DAG of a csg xml file
+class CSGNode:
+    def __init__(self, index, element, bindings, key):
+        self.index = index # Position in the file
+        self.element = element
+        self.name = element.attrib['name']
+        self.bindings = bindings # Operand name -> index of the node it refers to
+        self.operands = [bindings[operand.text.strip()] for operand in element.findall('operand')]
+        self.key = key # Content hash (see cache.node_hash)
+
+'''
+Builds the dependency DAG of the elements of a csg xml file.
+
+@param root: root of the xml tree
+@param tessellation: The Tessellation of the solids, part of their hashes
+@return: the nodes in file order (a topological order) and the index of the
+         node every name is bound to at the end of the file
+'''
+def build_csg_dag(root, tessellation=DEFAULT_TESSELLATION):
+    nodes = []
+    bindings = {}
+    for index, child in enumerate(root):
+        if child.tag not in ('solid', 'unary_op', 'binary_op'):
+            raise Exception("Unknown xml format")
+        operand_names = [operand.text.strip() for operand in child.findall('operand')]
+        operand_bindings = {name: bindings[name] for name in operand_names}
+        key = node_hash(child, [nodes[operand_bindings[name]].key for name in operand_names],
+                        tessellation.key() if child.tag == 'solid' else '')
+        nodes.append(CSGNode(index, child, operand_bindings, key))
+        bindings[child.attrib['name']] = index
+    return nodes, bindings
+
+'''
+Dead node elimination: the nodes the roots depend on (directly or through
+other nodes), including the roots themselves.
+Operands always come before the nodes using them, so a single backwards pass
+over the nodes finds all of them.
+
+@param nodes: the nodes of the dag in file order
+@param roots: indices of the nodes which are needed
+@param is_leaf: Optional test of needed nodes whose operands are not needed
+                (like nodes whose result is cached)
+@return: the needed nodes in file order
+'''
+def reachable_nodes(nodes, roots, is_leaf=None):
+    live = set(roots)
+    for node in reversed(nodes):
+        if node.index in live and not (is_leaf is not None and is_leaf(node)):
+            live.update(node.operands)
+    return [node for node in nodes if node.index in live]
+
+# Evaluates a solid or unary node in this process, reading its operands from 'results'
+def evaluate_node(node, results, tessellation=DEFAULT_TESSELLATION):
+    element = node.element
+    if element.tag == 'solid':
+        return parse_shape[element.attrib['shape']](element, tessellation)
+    return parse_unaries[element.attrib['type']](element, CSGBindings(results, node.bindings))
+
+'''
+Splits operands into two halves of nearby parts: the operands are sorted
+along the axis in which the centers of their bounding boxes spread the most
+and split at the median (a k-d tree split).
+
+@param items: indices of the operands
+@param centers: centers of the bounding boxes of the operands (len(items) x 3)
+@return: the indices of the two halves
+'''
+def spatial_split(items, centers):
+    axis = np.argmax(np.ptp(centers, axis=0))
+    order = np.argsort(centers[:, axis], kind='stable')
+    half = len(items) // 2
+    return [items[i] for i in order[:half]], [items[i] for i in order[half:]]
+
+'''
+Evaluates a csg xml file.
+The dependency graph of the file is built first, and only the nodes the
+target (and the names in 'keep') depend on are evaluated.
+Independent binary operations are run in a pool of 'workers' processes.
+Results are stored per node, so the outcome does not depend on the order in
+which the workers finish.
+A binary_op may list any number of operands. Unions and intersections are
+reduced as a balanced tree that combines spatially nearby operands first, a
+difference subtracts the balanced union of all operands but the first.
+Every intermediate mesh is freed as soon as its last consumer is done,
+unless its name is pinned by 'keep'. When 'keep' is given, the operands of
+binary operations found in the cache are not evaluated at all, so only the
+nodes which changed since the results were cached (and the nodes depending
+on them) are evaluated.
+
+@param xml_file: The csg xml file
+@param cache: Optional MeshCache for the results of the binary operations
+@param workers: Number of processes running binary operations (1 runs everything in this process)
+@param separation: Test skipping CGAL for separated operands ('aabb', 'obb' or None)
+@param keep: Names of other nodes to evaluate and return. The target is always
+             returned, None returns every name evaluated for the target.
+@param target: Name of the node to evaluate, the last node in the file if None
+@param primitives: Optional dict of the meshes of solids by node hash, which
+                   can be shared between the evaluation of several files
+@param tessellation: The Tessellation of the solids (by their own parameters if None)
+@param profiler: Optional Profiler recording the evaluation of every node
+@return: the csg graph (name -> Mesh) and the name of the target
+'''
+def parse_csg_graph(xml_file, cache=None, workers=1, separation='aabb', keep=None, target=None,
+                    primitives=None, tessellation=None, profiler=None):
+    if tessellation is None:
+        tessellation = DEFAULT_TESSELLATION
     # The tree from the xml file
     tree = ET.parse(xml_file)
     root = tree.getroot()
-    last_name = ''
-    for child in root:
-        if child.tag == 'solid':
-            # Get the identifier of the object
-            name = child.attrib['name']
-            # Shape name
-            shape = child.attrib['shape']
-            solid = parse_shape[shape](child)
-            csg_graph[name] = solid
-        elif child.tag == 'unary_op':
-            # Get the identifier of the object
-            name = child.attrib['name']
-            # Operation to perform
-            unary = child.attrib['type']
-            solid = parse_unaries[unary](child, csg_graph)
-            csg_graph[name] = solid
-        elif child.tag == 'binary_op':
-            # Get the identifier of the object
-            name = child.attrib['name']
-            # Operation to perform
-            op = child.attrib['type']
-            solid = parse_operations[op](child, csg_graph)
-            csg_graph[name] = solid
+    nodes, bindings = build_csg_dag(root, tessellation)
+    keys = {node.index: node.key for node in nodes}
+    if target is None:
+        target = nodes[-1].name if nodes else ''
+    wanted = ([target] if nodes else []) + list(keep or [])
+    for name in wanted:
+        if name not in bindings:
+            raise Exception("Unknown node '{}' in csg graph".format(name))
+    paths = {}
+    # Cached results of binary operations, by index
+    prefetched = {}
+    # Binary operations already looked up in the cache and not found
+    uncached = set()
+
+    def prefetch(node):
+        if keep is None or cache is None or node.element.tag != 'binary_op':
+            return False
+        cached = cache.get(node.key)
+        if cached is None:
+            uncached.add(node.index)
+            return False
+        paths[node.index] = 'cache'
+        prefetched[node.index] = [cached, np.eye(4), None]
+        return True
+    nodes = reachable_nodes(nodes, [bindings[name] for name in wanted], prefetch)
+    live = set(node.index for node in nodes)
+    # Nodes returned to the caller are never freed
+    if keep is None:
+        keep = [name for name, index in bindings.items() if index in live]
+    pinned = set(bindings[name] for name in keep) | set(bindings[name] for name in wanted)
+    # Number of nodes still to consume every node
+    consumers = Counter(operand for node in nodes for operand in node.operands)
+    # Placeholder which will contain all evaluated nodes of the csg graph (by index)
+    results = CSGGraph()
+
+    def release(index):
+        if consumers[index] <= 0 and index not in pinned and index in results:
+            del results[index]
+
+    def from_cache(node):
+        if cache is None or node.index in uncached:
+            return None
+        cached = cache.get(node.key)
+        if cached is None:
+            # n-ary operations come back here after they are expanded
+            uncached.add(node.index)
+            return None
+        paths[node.index] = 'cache'
+        return [cached, np.eye(4), None]
+
+    def store(node, solid, persist=True, path=None, timing=None):
+        if node.element.tag == 'binary_op' and cache is not None and persist:
+            cache.put(node.key, solid[0])
+        if profiler is not None:
+            profiler.end(node, solid[0], path or paths.get(node.index), timing)
+        results[node.index] = solid
+        # The operands of the node are no longer needed by it
+        for operand in node.operands:
+            consumers[operand] -= 1
+            release(operand)
+        release(node.index)
+
+    # Binary operations that can be done right away (cached or separated operands)
+    def evaluate_trivial(node):
+        solid = from_cache(node)
+        if solid is not None:
+            store(node, solid, persist=False)
+            return True
+        if len(node.operands) != 2:
+            return False
+        A = results[node.operands[0]]
+        B = results[node.operands[1]]
+        path = separating_test(A, B, separation)
+        if path is None:
+            return False
+        paths[node.index] = path
+        store(node, [separated_boolean(A, B, node.element.attrib['type']), np.eye(4), None],
+              persist=False)
+        return True
+
+    # Turns an n-ary operation into a balanced tree of binary nodes, which are
+    # scheduled like any other node. Returns the new nodes.
+    def expand(node):
+        op = node.element.attrib['type']
+        if len(node.operands) < 2:
+            raise Exception("Binary operation '{}' needs at least two operands".format(node.name))
+        new_nodes = []
+
+        def make_node(op, operands):
+            element = ET.Element('binary_op', {'name': '{}#{}'.format(node.name, len(new_nodes)),
+                                               'type': op})
+            operand_bindings = {}
+            for operand in operands:
+                ET.SubElement(element, 'operand').text = '#{}'.format(operand)
+                operand_bindings['#{}'.format(operand)] = operand
+            index = len(keys)
+            key = node_hash(element, [keys[operand] for operand in operands])
+            keys[index] = key
+            new_nodes.append(CSGNode(index, element, operand_bindings, key))
+            return index
+
+        def reduce_items(op, items):
+            if len(items) == 1:
+                return items[0]
+            left, right = spatial_split(items, centers(items))
+            return make_node(op, [reduce_items(op, left), reduce_items(op, right)])
+
+        operands = node.operands
+        if op == 'difference':
+            node.operands = [operands[0], reduce_items('union', operands[1:])]
         else:
-            raise Exception("Unknown xml format")
-        last_name = name
-    return csg_graph, last_name
+            left, right = spatial_split(operands, centers(operands))
+            node.operands = [reduce_items(op, left), reduce_items(op, right)]
+        # The original operands are now consumed by the new nodes instead
+        consumers.subtract(operands)
+        consumers.update(operand for new_node in new_nodes for operand in new_node.operands)
+        consumers.update(node.operands)
+        return new_nodes
+
+    def centers(items):
+        return np.array([results[item].center for item in items])
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        waiting = list(nodes)
+        running = {}
+        while waiting or running:
+            # Start every node whose operands are done, in file order
+            progressed = False
+            still_waiting = []
+            for node in waiting:
+                if node.index in prefetched:
+                    progressed = True
+                    if profiler is not None:
+                        profiler.begin(node, [])
+                    store(node, prefetched.pop(node.index), persist=False)
+                    continue
+                if not all(operand in results for operand in node.operands):
+                    still_waiting.append(node)
+                    continue
+                progressed = True
+                if profiler is not None:
+                    profiler.begin(node, [results.node(operand)[0] for operand in node.operands])
+                if node.element.tag == 'solid' and primitives is not None:
+                    shared = node.key in primitives
+                    if not shared:
+                        primitives[node.key] = evaluate_node(node, results, tessellation)[0]
+                    store(node, [primitives[node.key], np.eye(4), None],
+                          path='primitives' if shared else None)
+                elif node.element.tag != 'binary_op':
+                    # Solids and unary ops are cheap, evaluate them right away
+                    store(node, evaluate_node(node, results, tessellation))
+                elif evaluate_trivial(node):
+                    pass
+                elif len(node.operands) != 2:
+                    still_waiting.extend(expand(node))
+                    still_waiting.append(node)
+                else:
+                    op = node.element.attrib['type']
+                    A = results[node.operands[0]]
+                    B = results[node.operands[1]]
+                    if pool is None:
+                        paths[node.index] = 'cgal'
+                        store(node, [mesh_boolean(A, B, op), np.eye(4), None])
+                    elif profiler is not None:
+                        # The time is measured in the worker, not waiting for it
+                        running[pool.submit(measure, run_boolean, op, A, B)] = node
+                    else:
+                        running[pool.submit(run_boolean, op, A, B)] = node
+            waiting = still_waiting
+            if not progressed:
+                if not running:
+                    raise Exception("Unresolvable operands in csg graph")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    paths[node.index] = 'cgal'
+                    if profiler is not None:
+                        mesh, timing = future.result()
+                        store(node, [mesh, np.eye(4), None], timing=timing)
+                    else:
+                        store(node, [future.result(), np.eye(4), None])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # The graph by name, every name refers to the last node bound to it
+    csg_graph = CSGGraph()
+    for name, index in bindings.items():
+        if index in results:
+            csg_graph[name] = results.node(index)
+        if index in paths:
+            csg_graph.paths[name] = paths[index]
+    return csg_graph, target
+
+'''
+Cleans up a mesh before it is saved: coincident vertices are welded, which
+drops degenerate and doubled faces, and then it is optionally decimated.
+
+@param weld_tolerance: Vertices closer than this are merged
+@param max_faces, max_error: Bounds of the decimation (not decimated if both are None)
+@return: the mesh to save
+'''
+def prepare_export(mesh, weld_tolerance=WELD_TOLERANCE, max_faces=None, max_error=None):
+    return decimate(mesh.welded(weld_tolerance), max_faces, max_error)
+
+# Saves a mesh as a binary mesh file if the name ends with .xmesh, else as stl
+def save_result(fname, mesh):
+    if is_mesh_file(fname):
+        save_mesh(fname, mesh)
+    else:
+        save_to_stl(fname, mesh.V, mesh.F)
+
+# argparse type of options which must be strictly positive
+def positive_float(text):
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError("must be positive, got {}".format(text))
+    return value
+
+# Command line options shared by the tools building a csg graph
+def add_build_arguments(parser):
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Directory of the on-disk cache of boolean results (disabled if not given)')
+    parser.add_argument('--cache-size', type=float, default=1024., metavar='MB',
+                        help='Size limit of the cache, least recently used results are evicted')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes running independent boolean operations')
+    parser.add_argument('--separation', choices=['aabb', 'obb', 'none'], default='aabb',
+                        help='Test skipping CGAL for boolean operations on separated operands')
+    parser.add_argument('--tolerance', type=positive_float, metavar='T',
+                        help='Chordal error of curved solids in model units, overrides their refining/resolution')
+    parser.add_argument('--preview', action='store_true',
+                        help='Tessellate coarsely, for a quick preview')
+    parser.add_argument('--profile', type=int, metavar='N',
+                        help='Print the N nodes which took the longest to evaluate')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='Save the evaluation time, size and memory use of every node as json')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Save the evaluation of the nodes in the Chrome trace event format')
+    parser.add_argument('--weld-tolerance', type=float, default=WELD_TOLERANCE, metavar='T',
+                        help='Merge vertices closer than T in the result before it is saved (0: only equal ones)')
+    parser.add_argument('--decimate-faces', type=int, metavar='N',
+                        help='Decimate the result to at most N faces before it is saved')
+    parser.add_argument('--decimate-error', type=float, metavar='E',
+                        help='Decimate the result within the quadric error E (model units) before it is saved')
+
+def separation_from_args(args):
+    return None if args.separation == 'none' else args.separation
+
+def tessellation_from_args(args):
+    return Tessellation(args.tolerance, args.preview)
+
+# Keyword arguments of prepare_export
+def export_from_args(args):
+    return {'weld_tolerance': args.weld_tolerance,
+            'max_faces': args.decimate_faces, 'max_error': args.decimate_error}
+
+def profiler_from_args(args):
+    if args.profile is None and args.profile_json is None and args.trace is None:
+        return None
+    return Profiler()
+
+# Prints and saves what the profiling options ask for
+def report_profile(profiler, args):
+    if profiler is None:
+        return
+    if args.profile is not None:
+        print(profiler.table(args.profile), file=sys.stderr)
+    if args.profile_json is not None:
+        profiler.save_json(args.profile_json)
+    if args.trace is not None:
+        profiler.save_chrome_trace(args.trace)
+
+def cache_from_args(args):
+    if args.cache is None:
+        return None
+    return MeshCache(args.cache, int(args.cache_size * 2**20))
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: csgxml.py [filename]")
-        exit()
-
-    FNAME = sys.argv[1]
-    csg_graph, last_name = parse_csg_graph(FNAME)
-    VLast, FLast = csg_graph[last_name]
+    parser = argparse.ArgumentParser(description='Show (and optionally save) a solid of a csg xml file')
+    parser.add_argument('filename')
+    parser.add_argument('stl_name', nargs='?', help='Save the solid as stl, or as a binary mesh file (.xmesh)')
+    parser.add_argument('--target', help='Name of the solid to show (the last one if not given)')
+    add_build_arguments(parser)
+    args = parser.parse_args()
+
+    profiler = profiler_from_args(args)
+    csg_graph, last_name = parse_csg_graph(args.filename, cache=cache_from_args(args),
+                                           workers=args.workers,
+                                           separation=separation_from_args(args),
+                                           keep=[], target=args.target,
+                                           tessellation=tessellation_from_args(args),
+                                           profiler=profiler)
+    report_profile(profiler, args)
+    last = csg_graph[last_name]
     print(last_name)
 
-    save = False
-    if len(sys.argv) > 2:
-        save = True
-        stl_name = sys.argv[2]
-
     viewer = igl.glfw.Viewer()
     viewer.data().clear()
-    viewer.data().set_mesh(VLast, FLast)
+    viewer.data().set_mesh(*to_igl(last))
     viewer.data().show_lines = True
     viewer.launch()
 
-    if save:
-        save_to_stl(stl_name, np.array(VLast), np.array(FLast))
+    if args.stl_name is not None:
+        last = prepare_export(last, **export_from_args(args))
+        save_result(args.stl_name, last)
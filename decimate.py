@@ -0,0 +1,215 @@
+import numpy as np
+from mesh import Mesh
+
+# Faces whose normal turns by more than this (as a cosine) veto a collapse
+MIN_NORMAL_COSINE = 0.1
+# Rounds of picking the independent collapses of a pass
+SELECTION_ROUNDS = 8
+
+'''
+Plane quadrics of the faces summed per vertex: for the plane (n, d) of a face
+with unit normal n, the quadric is [n, d][n, d]^T, so [p, 1] Q [p, 1]^T is the
+sum of the squared distances of p to the planes of the faces of the vertex.
+
+@param V: Vertices (n x 3)
+@param F: Faces (m x 3)
+@return: quadrics (n x 4 x 4)
+'''
+def vertex_quadrics(V, F):
+    T = V[F]
+    N = np.cross(T[:, 1] - T[:, 0], T[:, 2] - T[:, 0])
+    lengths = np.linalg.norm(N, axis=1)
+    N /= np.where(lengths > 0, lengths, 1.0)[:, None]
+    P = np.column_stack([N, -np.einsum('ij,ij->i', N, T[:, 0])])
+    K = (P[:, :, None] * P[:, None, :]).reshape(-1, 16)
+    # Every face adds its quadric to its three vertices
+    W = np.repeat(K, 3, axis=0)
+    Q = np.column_stack([np.bincount(F.ravel(), W[:, j], minlength=len(V)) for j in range(16)])
+    return Q.reshape(-1, 4, 4)
+
+'''
+Best position and cost of collapsing edges. The position minimizing the
+summed quadric is found with a small pull towards the midpoint, which keeps
+flat and straight regions well posed; the endpoints and the midpoint are
+tried as well.
+
+@param Q: Quadrics of the vertices
+@param V: Vertices
+@param E: Edges (k x 2)
+@return: positions (k x 3) and costs (k) of the collapses
+'''
+def collapse_costs(Q, V, E):
+    QE = Q[E[:, 0]] + Q[E[:, 1]]
+    A, b = QE[:, :3, :3], QE[:, :3, 3]
+    mid = (V[E[:, 0]] + V[E[:, 1]]) / 2.0
+    lam = 1e-6 * np.trace(A, axis1=1, axis2=2) + 1e-12
+    optimal = np.linalg.solve(A + lam[:, None, None] * np.eye(3),
+                              (lam[:, None] * mid - b)[:, :, None])[:, :, 0]
+    candidates = np.stack([optimal, mid, V[E[:, 0]], V[E[:, 1]]], axis=1)
+    H = np.concatenate([candidates, np.ones(candidates.shape[:2] + (1,))], axis=2)
+    costs = np.einsum('kci,kij,kcj->kc', H, QE, H)
+    best = np.argmin(costs, axis=1)
+    rows = np.arange(len(E))
+    return candidates[rows, best], np.maximum(costs[rows, best], 0.0)
+
+'''
+Link condition of edges of a closed manifold mesh: the endpoints of an edge
+may only have the two vertices opposite the edge as common neighbours, and
+a tetrahedron is never collapsed. Collapsing such an edge keeps the mesh
+manifold.
+
+@param E: Edges (k x 2)
+@param ptr: Neighbours of vertex v are nbr[ptr[v]:ptr[v+1]]
+@param nbr: Sorted neighbour lists of the vertices
+@param keys: Sorted keys v*n + w of all (directed) edges (v, w)
+@param n: Number of vertices
+@return: mask of the edges satisfying the condition
+'''
+def link_condition(E, ptr, nbr, keys, n):
+    a, b = E[:, 0], E[:, 1]
+    valence = np.diff(ptr)
+    # Every neighbour c of a, tagged with the edge it belongs to
+    counts = valence[a]
+    edge = np.repeat(np.arange(len(E)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    c = nbr[np.repeat(ptr[a], counts) + offsets]
+    # ... which is a neighbour of b as well
+    query = b[edge].astype(np.int64) * n + c
+    found = np.searchsorted(keys, query)
+    found = (found < len(keys)) & (keys[np.minimum(found, len(keys) - 1)] == query)
+    common = np.bincount(edge[found], minlength=len(E))
+    return (common == 2) & ~((valence[a] == 3) & (valence[b] == 3))
+
+'''
+Independent edges to collapse together, picked in rounds: an edge is picked
+when it is the cheapest of the remaining edges within one edge of its
+endpoints, and the edges with an endpoint next to the endpoints of a picked
+edge are dropped. No two picked edges have endpoints which are neighbours,
+so their collapses touch disjoint faces. Run to the end the rounds pick the
+same edges as going through the edges greedily, cheapest first.
+
+@param E: Edges (k x 2)
+@param costs: Costs of collapsing the edges
+@param keys: Sorted keys v*n + w of all (directed) edges (v, w)
+@param n: Number of vertices
+@param rounds: Maximum number of rounds
+@return: indices of the picked edges, cheapest first
+'''
+def independent_edges(E, costs, keys, n, rounds=SELECTION_ROUNDS):
+    order = np.argsort(costs, kind='stable')
+    rank = np.empty(len(E), dtype=np.int64)
+    rank[order] = np.arange(len(E))
+    src, dst = keys // n, keys % n
+    picked = np.zeros(len(E), dtype=bool)
+    remaining = np.ones(len(E), dtype=bool)
+    for _ in range(rounds):
+        if not remaining.any():
+            break
+        # The rank of the cheapest remaining edge at each vertex, then within one edge of it
+        at_vertex = np.full(n, len(E), dtype=np.int64)
+        np.minimum.at(at_vertex, E[remaining, 0], rank[remaining])
+        np.minimum.at(at_vertex, E[remaining, 1], rank[remaining])
+        near_vertex = at_vertex.copy()
+        np.minimum.at(near_vertex, src, at_vertex[dst])
+        new = remaining & (near_vertex[E[:, 0]] == rank) & (near_vertex[E[:, 1]] == rank)
+        picked |= new
+        # The endpoints of the new edges and their neighbours are locked
+        locked = np.zeros(n, dtype=bool)
+        locked[E[new].ravel()] = True
+        locked[dst[locked[src]]] = True
+        remaining &= ~locked[E].any(axis=1)
+    return order[picked[order]]
+
+'''
+Simplifies a closed triangle mesh by quadric error edge collapses
+(Garland & Heckbert). Collapses are done in passes: of the cheapest edges a
+pass picks independent ones (see independent_edges), cheapest first, so all
+collapses of a pass are applied at once.
+Edges on boundaries or non-manifold edges (and their vertices) are never
+collapsed, collapses breaking the link condition or flipping faces are
+skipped, so a watertight mesh stays watertight.
+
+@param mesh: The Mesh to simplify
+@param max_faces: Stop once the mesh has at most this many faces
+@param max_error: Only collapse edges whose quadric error (a distance in
+                  model units) is at most this
+@return: the simplified Mesh
+'''
+def decimate(mesh, max_faces=None, max_error=None):
+    if (max_faces is None and max_error is None) or len(mesh.F) == 0:
+        return mesh
+    V = mesh.V.copy()
+    F = mesh.F.astype(np.int64)
+    n = len(V)
+    Q = vertex_quadrics(V, F)
+    bound = np.inf if max_error is None else max_error ** 2
+    target = 0 if max_faces is None else max_faces
+    # Collapses vetoed by the normal test since the mesh last changed, by edge key
+    blocked = np.zeros(0, dtype=np.int64)
+    while len(F) > target:
+        # The undirected edges and the number of faces at each of them
+        D = np.concatenate([F[:, [0, 1]], F[:, [1, 2]], F[:, [2, 0]]])
+        edge_keys, face_counts = np.unique(np.sort(D, axis=1) @ np.array([n, 1]), return_counts=True)
+        E = np.column_stack([edge_keys // n, edge_keys % n])
+        fixed = np.zeros(n, dtype=bool)
+        fixed[E[face_counts != 2].ravel()] = True
+        # The neighbours of every vertex
+        keys = np.sort(np.concatenate([edge_keys, E[:, 1] * n + E[:, 0]]))
+        ptr = np.searchsorted(keys // n, np.arange(n + 1))
+        nbr = keys % n
+
+        ok = (face_counts == 2) & ~fixed[E].any(axis=1) & ~np.isin(edge_keys, blocked)
+        E, edge_keys = E[ok], edge_keys[ok]
+        positions, costs = collapse_costs(Q, V, E)
+        ok = (costs <= bound) & link_condition(E, ptr, nbr, keys, n)
+        E, edge_keys, positions, costs = E[ok], edge_keys[ok], positions[ok], costs[ok]
+
+        # Independent collapses, cheapest first
+        budget = (len(F) - target + 1) // 2
+        # A pass collapses no edge costlier than the 'budget' cheapest ones
+        cheap = np.flatnonzero(costs <= np.partition(costs, budget - 1)[budget - 1]) \
+                if budget < len(costs) else np.arange(len(costs))
+        chosen = cheap[independent_edges(E[cheap], costs[cheap], keys, n)][:budget]
+        if len(chosen) == 0:
+            break
+
+        # Normal test of the faces around every collapse
+        owner = np.full(n, -1)
+        owner[E[chosen, 0]] = np.arange(len(chosen))
+        owner[E[chosen, 1]] = np.arange(len(chosen))
+        FO = owner[F]
+        touched = (FO >= 0).any(axis=1)
+        FT, FO = F[touched], FO[touched]
+        collapse = FO.max(axis=1)
+        removed = (FO >= 0).sum(axis=1) == 2
+        old = V[FT]
+        new = old.copy()
+        new[FO >= 0] = positions[chosen][FO[FO >= 0]]
+        N_old = np.cross(old[:, 1] - old[:, 0], old[:, 2] - old[:, 0])
+        N_new = np.cross(new[:, 1] - new[:, 0], new[:, 2] - new[:, 0])
+        length_old = np.linalg.norm(N_old, axis=1)
+        bad = ~removed & (length_old > 0) & \
+              (np.einsum('ij,ij->i', N_old, N_new) <= MIN_NORMAL_COSINE * length_old * np.linalg.norm(N_new, axis=1))
+        rejected = np.zeros(len(chosen), dtype=bool)
+        rejected[collapse[bad]] = True
+        accepted = chosen[~rejected]
+        if len(accepted) > 0:
+            # Collapses change the neighbourhoods the vetoes were made in
+            blocked = edge_keys[chosen[rejected]]
+        else:
+            blocked = np.concatenate([blocked, edge_keys[chosen[rejected]]])
+
+        # Collapse b onto a
+        a, b = E[accepted, 0], E[accepted, 1]
+        V[a] = positions[accepted]
+        Q[a] += Q[b]
+        remap = np.arange(n)
+        remap[b] = a
+        F = remap[F]
+        F = F[(F[:, 0] != F[:, 1]) & (F[:, 1] != F[:, 2]) & (F[:, 2] != F[:, 0])]
+
+    # Drop the collapsed vertices
+    used = np.unique(F)
+    remap = np.full(n, -1)
+    remap[used] = np.arange(len(used))
+    return Mesh(V[used], remap[F])
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+import numpy as np
+from mesh import Mesh
+from factory import make_cuboid
+from decimate import decimate
+
+def test_text(result):
+    return "Success" if result else "Failed"
+
+# Volume enclosed by a closed mesh
+def volume(mesh):
+    T = mesh.V[mesh.F]
+    return np.einsum('ij,ij->i', T[:, 0], np.cross(T[:, 1], T[:, 2])).sum() / 6.0
+
+# A refined box, its faces only have flat (zero error) collapses until it is the plain box
+box = Mesh(*make_cuboid((1, 2, 3), refining=3))
+
+# Test 0: Decimating without error gives the plain box
+D = decimate(box, max_error=0.0)
+print("Test 0 (Decimate a refined box without error):",
+      test_text(len(D.V) == 8 and len(D.F) == 12 and np.isclose(volume(D), 6.0)))
+
+# Test 1: Decimating to 12 faces collapses the flat faces first, the corners are kept
+D = decimate(box, max_faces=12)
+print("Test 1 (Decimate a refined box to 12 faces):",
+      test_text(len(D.F) == 12 and np.isclose(volume(D), 6.0)))
@@ -1,13 +1,201 @@
 import math
-import sys
 import numpy as np
-from stl import mesh
 from functools import reduce
+from collections import OrderedDict
+from mesh import Mesh
 
-# Add pyigl to the path
-PATH_TO_LIBIGL = '/home/max/diku/2018/project2018b2/SoftRoboticDesign/robot_designs/libigl/python'
-sys.path.insert(0, PATH_TO_LIBIGL)
-import pyigl as igl
+'''
+Subdivides every triangle of an indexed mesh into four by splitting its edges.
+Edge midpoints are shared between neighbouring faces, so a watertight input
+stays watertight.
+
+@param V: Vertices of the mesh (n x 3)
+@param F: Faces of the mesh (m x 3)
+@param radius: If given, the new midpoints are projected onto the sphere of
+               this radius centered at the origin
+@return: vertices and faces of the refined mesh (V, F)
+'''
+def subdivide(V, F, radius=None):
+    V = np.asarray(V, dtype=np.float64)
+    F = np.asarray(F, dtype=np.int32)
+    # The three edges of every face: (v0,v1), (v1,v2), (v2,v0)
+    E = np.stack([F[:, [0, 1]], F[:, [1, 2]], F[:, [2, 0]]], axis=1).reshape(-1, 2)
+    # Key every edge by its sorted endpoints so both faces sharing it agree
+    E_unique, E_index = np.unique(np.sort(E, axis=1), axis=0, return_inverse=True)
+    # The midpoints of the unique edges
+    VMid = (V[E_unique[:, 0]] + V[E_unique[:, 1]]) / 2.0
+    if radius is not None:
+        VMid *= radius / np.linalg.norm(VMid, axis=1)[:, None]
+    # Index of the midpoints of (v0,v1), (v1,v2) and (v2,v0) for every face
+    M = (E_index.reshape(-1, 3) + V.shape[0]).astype(np.int32)
+    v0, v1, v2 = F[:, 0], F[:, 1], F[:, 2]
+    v3, v4, v5 = M[:, 0], M[:, 1], M[:, 2]
+    FRefined = np.stack([np.stack([v0, v3, v5], axis=1),
+                         np.stack([v1, v4, v3], axis=1),
+                         np.stack([v2, v5, v4], axis=1),
+                         np.stack([v3, v4, v5], axis=1)], axis=1).reshape(-1, 3)
+    return np.vstack([V, VMid]), FRefined
+
+# Unit templates of the primitives by (kind, level), the least recently used first
+templates = OrderedDict()
+# Number of templates kept in memory
+MAX_TEMPLATES = 32
+
+'''
+Memoizes the unit template of a primitive. A template is shared by all of
+its instances, so its arrays are made read-only. It is welded once when it
+is built, an affine map of a welded template has no coincident vertices
+either, so its instances need no welding.
+
+@param key: (kind, level) identifying the template
+@param build: Function building the template if it is not cached
+@return: vertices and faces of the template (V, F)
+'''
+def get_template(key, build):
+    if key in templates:
+        templates.move_to_end(key)
+        return templates[key]
+    V, F = Mesh(*build()).welded()
+    V.flags.writeable = False
+    F.flags.writeable = False
+    templates[key] = (V, F)
+    if len(templates) > MAX_TEMPLATES:
+        templates.popitem(last=False)
+    return V, F
+
+'''
+Instance of a template under the affine map x -> A x + b, computed with a
+single matmul. The faces are shared with the template.
+
+@param template: vertices and faces of the template (V, F)
+@param A: 3x3 linear part of the map (scale and rotation)
+@param b: translation of the map
+@return: vertices and faces of the instance (V, F)
+'''
+def instantiate(template, A, b):
+    V, F = template
+    return V @ np.asarray(A, dtype=np.float64).T + b, F
+
+'''
+The cube [-1, 1]^3 subdivided 'refining' times.
+'''
+def unit_cuboid(refining):
+    def build():
+        if refining == 0:
+            # The vertices of the cube
+            V = np.array([[-1, 1, 1], [-1, 1, -1], [1, 1, -1], [1, 1, 1],
+                          [1, -1, 1], [1, -1, -1], [-1 ,-1, -1], [-1, -1, 1]], dtype=np.float64)
+            # Faces of the cube (ensures outward normals)
+            F = np.array([[3,1,0],[3,2,1],
+                          [4,2,3],[4,5,2],
+                          [4,0,7],[4,3,0],
+                          [7,5,4],[7,6,5],
+                          [0,6,7],[0,1,6],
+                          [6,2,5],[6,1,2]], dtype=np.int32)
+            return V, F
+        return subdivide(*unit_cuboid(refining - 1))
+    return get_template(('cuboid', refining), build)
+
+'''
+Cylinder of radius 1 from (0,0,0) to (0,0,1) with 'resolution' points on
+each circle. The vertices are the center of the start circle, its points,
+the center of the end circle and its points.
+'''
+def unit_cylinder(resolution):
+    def build():
+        n = resolution
+        # The circle points run clockwise seen from the end, so the faces point outwards
+        rotation = (2 * np.pi / n) * np.arange(n)
+        circle = np.column_stack([np.cos(rotation), -np.sin(rotation), np.zeros(n)])
+        V = np.vstack([[0., 0., 0.], circle, [0., 0., 1.], circle + [0., 0., 1.]])
+        # Every point i of a circle and the point j after it
+        i = np.arange(1, n+1, dtype=np.int32)
+        j = i % n + 1
+        start = np.zeros(n, dtype=np.int32)
+        end = np.full(n, n+1, dtype=np.int32)
+        # Faces of the start circle, the end circle and the sides connecting them
+        F = np.vstack([np.column_stack([start, i, j]),
+                       np.column_stack([end, n+1+j, n+1+i]),
+                       np.stack([np.column_stack([i, n+1+i, n+1+j]),
+                                 np.column_stack([n+1+j, j, i])], axis=1).reshape(-1, 3)])
+        return V, F.astype(np.int32)
+    return get_template(('cylinder', resolution), build)
+
+'''
+Icosahedron subdivided 'refining' times with all vertices on the unit sphere.
+'''
+def unit_sphere(refining):
+    def build():
+        if refining > 0:
+            return subdivide(*unit_sphere(refining - 1), radius=1.0)
+        # The golden ratio
+        t = (1.0 + np.sqrt(5.0)) / 2.0
+        # Three orthogonal rectangles
+        V = np.array([[-1., t, 0.], [1., t, 0.], [-1., -t, 0.], [1., -t, 0.],
+                      [0., -1., t], [0., 1., t], [0., -1., -t], [0., 1., -t],
+                      [t, 0., -1.], [t, 0., 1.], [-t, 0., -1.], [-t, 0., 1.]])
+        F = np.array([# 5 faces around point 0
+                      [0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      # 5 adjacent faces
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      # 5 faces around point 3
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      # 5 adjacent faces
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int32)
+        return V / np.sqrt(t*t + 1), F
+    return get_template(('sphere', refining), build)
+
+# Limits of the tessellation derived from a tolerance
+MAX_REFINING = 7
+MAX_RESOLUTION = 4096
+# Largest distance between the unit sphere and unit_sphere(refining), by refining
+sphere_errors = {}
+
+'''
+Largest distance between the unit sphere and the faces of
+unit_sphere(refining): the distance from the sphere to the plane of the
+face closest to the center.
+'''
+def unit_sphere_error(refining):
+    if refining not in sphere_errors:
+        V, F = unit_sphere(refining)
+        T = V[F]
+        N = np.cross(T[:, 1] - T[:, 0], T[:, 2] - T[:, 0])
+        N /= np.linalg.norm(N, axis=1)[:, None]
+        sphere_errors[refining] = 1.0 - np.min(np.abs(np.einsum('ij,ij->i', N, T[:, 0])))
+    return sphere_errors[refining]
+
+'''
+The fewest subdivisions of the Icosahedron approximating a sphere within a
+chordal tolerance.
+
+@param radius: Radius of the sphere
+@param tolerance: Largest distance between the sphere and its triangles
+@return: the refining parameter of make_sphere
+'''
+def sphere_refining(radius, tolerance):
+    if not tolerance > 0:
+        raise Exception("The tolerance must be positive, got {}".format(tolerance))
+    for refining in range(MAX_REFINING):
+        if radius * unit_sphere_error(refining) <= tolerance:
+            return refining
+    return MAX_REFINING
+
+'''
+The fewest points on a circle approximating it within a chordal tolerance:
+a chord spanning the angle 2*pi/n is r*(1 - cos(pi/n)) from the circle.
+
+@param radius: Radius of the circle
+@param tolerance: Largest distance between the circle and its chords
+@return: the resolution parameter of make_cylinder
+'''
+def cylinder_resolution(radius, tolerance):
+    if not tolerance > 0:
+        raise Exception("The tolerance must be positive, got {}".format(tolerance))
+    if tolerance >= radius:
+        return 3
+    resolution = int(np.ceil(np.pi / np.arccos(1.0 - tolerance / radius)))
+    return min(max(resolution, 3), MAX_RESOLUTION)
 
 '''
 Implementation of a 3D-pyramid.
@@ -49,8 +237,10 @@ Implementation of a 3D-cube.
 @param center: a point (x_0, y_0, z_0) that the cuboid is centered about
 @return: vertices and faces of the cuboid (V, F)
 @param scale: Scale of the solid
+@param tolerance: Chordal tolerance, overrides refining. The faces of a
+                  cuboid are flat, so it is not refined at all.
 '''
-def make_cuboid(size, center=(0.,0.,0.), scale=1.0, refining=1):
+def make_cuboid(size, center=(0.,0.,0.), scale=1.0, refining=1, tolerance=None):
     # For easier xml parsing
     if center is None:
         center = (0., 0., 0.)
@@ -63,62 +253,29 @@ def make_cuboid(size, center=(0.,0.,0.), scale=1.0, refining=1):
     if len(center) != 3:
         raise Exception("Center must be a 3-dimensional vector")
 
-    x, y, z = size
-    # The vertices of the cuboid
-    V = np.array([[-x, y, z], [-x, y, -z], [x, y, -z], [x, y, z],
-                  [x, -y, z], [x, -y, -z], [-x ,-y, -z], [-x, -y, z]])
+    if tolerance is not None:
+        refining = 0
     # Making sure the scale is correct and that the cube is centered around 'center'
-    V = (V * scale / 2.0 + center)
-    # Faces of the cuboid (ensures outward normals)
-    F = np.array([[3,1,0],[3,2,1],
-                  [4,2,3],[4,5,2],
-                  [4,0,7],[4,3,0],
-                  [7,5,4],[7,6,5],
-                  [0,6,7],[0,1,6],
-                  [6,2,5],[6,1,2]], dtype=np.int32)
-
-
-    for _ in range(refining):
-        FRefined = []
-        VRefined = []
-        for i,f in enumerate(F):
-            v0 = V[f[0]]
-            v1 = V[f[1]]
-            v2 = V[f[2]]
-            v3 = [(v0[0] + v1[0]) / 2.0, (v0[1] + v1[1]) / 2.0, (v0[2] + v1[2]) / 2.0]
-            v4 = [(v1[0] + v2[0]) / 2.0, (v1[1] + v2[1]) / 2.0, (v1[2] + v2[2]) / 2.0]
-            v5 = [(v2[0] + v0[0]) / 2.0, (v2[1] + v0[1]) / 2.0, (v2[2] + v0[2]) / 2.0]
-            # Add the new vertices to VRefined
-            VRefined.append(v0)
-            VRefined.append(v1)
-            VRefined.append(v2)
-            VRefined.append(v3)
-            VRefined.append(v4)
-            VRefined.append(v5)
-            # Add the new faces to FRefined
-            idx = i * 6
-            FRefined.append([idx, idx+3, idx+5])
-            FRefined.append([idx+1, idx+4, idx+3])
-            FRefined.append([idx+2, idx+5, idx+4])
-            FRefined.append([idx+3, idx+4, idx+5])
-        V = VRefined
-        F = np.array(FRefined, dtype=np.int32)
-    return V, F
+    A = np.diag(np.asarray(size, dtype=np.float64) * scale / 2.0)
+    return instantiate(unit_cuboid(refining), A, center)
 
 '''
-Implementation for approximating a cylinder.
+Implementation for approximating a cylinder along any axis.
 @param start: The center of the start of the cylinder
 @param end: The center of the end of the cylinder
 @param scale: The scale of the cylinder
 @param resolution: The amount of points used to approximate circles
+@param tolerance: Chordal tolerance the circles are approximated within, overrides resolution
 @return: vertices and faces of the cylinder (V, F)
 '''
-def make_cylinder(start, end, radius=1.0, resolution=8):
+def make_cylinder(start, end, radius=1.0, resolution=8, tolerance=None):
     # For easier xml parsing
     if radius is None:
         radius = 1.0
     if resolution is None:
         resolution = 8
+    if tolerance is not None:
+        resolution = cylinder_resolution(radius, tolerance)
 
     if len(start) != 3:
         raise Exception("Center must be a 3-dimensional vector")
@@ -138,77 +295,20 @@ def make_cylinder(start, end, radius=1.0, resolution=8):
     if xs > xe or ys > ye or zs > ze:
         xs, ys, zs = end   # Center of the end of the clyinder
         xe, ye, ze = start   # Center of the start of the cylinder
-    # Depending on orientation, determine circle points
-    if xs - xe != 0:
-        V = [[xs, ys, zs]] # The center
-        for i in range(resolution):
-            rotation = -(2 * np.pi / resolution) * i
-            ys_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + ys
-            zs_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + zs
-            V.append([xs, ys_rotated, zs_rotated])
-        V.append([xe, ye, ze]) # The center
-        for i in range(resolution):
-            rotation = -(2 * np.pi / resolution) * i
-            ye_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + ye
-            ze_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + ze
-            V.append([xe, ye_rotated, ze_rotated])
-
-    if ys - ye != 0:
-        V = [[xs, ys, zs]] # The center
-        for i in range(resolution):
-            rotation = (2 * np.pi / resolution) * i
-            xs_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + xs
-            zs_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + zs
-            V.append([xs_rotated, ys, zs_rotated])
-        # Vertices of the "end circle"
-        V.append([xe, ye, ze]) # The center
-        for i in range(resolution):
-            rotation = (2 * np.pi / resolution) * i
-            xe_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + xe
-            ze_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + ze
-            V.append([xe_rotated, ye, ze_rotated])
-
-    if zs - ze != 0:
-        V = [[xs, ys, zs]] # The center
-        for i in range(resolution):
-            rotation = -(2 * np.pi / resolution) * i
-            xs_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + xs
-            ys_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + ys
-            V.append([xs_rotated, ys_rotated, zs])
-        # Vertices of the "end circle"
-        V.append([xe, ye, ze]) # The center
-        for i in range(resolution):
-            rotation = -(2 * np.pi / resolution) * i
-            xe_rotated = (radius * np.cos(rotation) - 0 * np.sin(rotation)) + xe
-            ye_rotated = (0 * np.cos(rotation) + radius * np.sin(rotation)) + ye
-            V.append([xe_rotated, ye_rotated, ze])
-    V = np.array(V)
-    # Computing faces
-    F = []
-    # Computing faces for the start circle
-    for i in range(1, resolution+1):
-        # 0 := center
-        if i == resolution:
-            F.append([0, i, 1])
-        else:
-            F.append([0, i, i+1])
-    # Computing faces for the end circle
-    for i in range(1, resolution+1):
-        # resolution := center
-        if i == resolution:
-            F.append([resolution+1, resolution+2, resolution+1+i])
-        else:
-            F.append([resolution+1, resolution+2+i, resolution+1+i])
-    # Computing faces for the sides connecting the circles
-    for i in range(1, resolution+1):
-        if i == resolution:
-            F.append([resolution, resolution*2+1, resolution+2])
-            F.append([resolution+2, 1, resolution])
-        else:
-            F.append([i, resolution+1+i, resolution+2+i])
-            F.append([resolution+2+i, i+1, i])
-    F = np.array(F, np.int32)
-    return V, F
+    start = np.array([xs, ys, zs])
+    axis = np.array([xe, ye, ze]) - start
+    length = np.linalg.norm(axis)
+    if length == 0:
+        raise Exception("Start and end of a cylinder must differ")
+    # Orthonormal frame (e1, e2, d) of the cylinder. The circles start at the
+    # x-axis, or the y-axis for cylinders along the x-axis.
+    d = axis / length
+    ref = np.array([1., 0., 0.]) if abs(d[0]) < 0.9 else np.array([0., 1., 0.])
+    e1 = ref - np.dot(ref, d) * d
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(d, e1)
+    A = np.column_stack([radius * e1, radius * e2, axis])
+    return instantiate(unit_cylinder(resolution), A, start)
 
 '''
 Implementation of a Icosahedron for approximating a sphere.
@@ -216,115 +316,33 @@ Implementation of a Icosahedron for approximating a sphere.
 @param center: The center of the sphere
 @param scale: The scale of the sphere
 @param refining: The amount of times the triangles of the Icosahedron should be subdivided.
+@param tolerance: Chordal tolerance the sphere is approximated within, overrides refining
 @return: vertices and faces of the sphere (V, F)
 '''
-def make_sphere(center, scale=1.0, refining=1):
+def make_sphere(center, scale=1.0, refining=1, tolerance=None):
     if len(center) != 3:
         raise Exception("Center must be a 3-dimensional vector")
-    # Initial 12 vertices of the sphere
-    x, y, z = center
-    # Vertices
-    V = []
-    # The golden ratio
-    t = (1.0 + np.sqrt(5.0)) / 2.0
+    # For easier xml parsing
+    if scale is None:
+        scale = 1.0
+    if refining is None:
+        refining = 1
+    radius = sphere_radius(scale)
+    if tolerance is not None:
+        refining = sphere_refining(radius, tolerance)
+    # The sphere is built about the origin
+    return instantiate(unit_sphere(refining), np.eye(3) * radius, np.zeros(3))
 
-    # First rectangle
-    V.append([-scale, t*scale, 0.])
-    V.append([scale, t*scale, 0.])
-    V.append([-scale, -t*scale, 0.])
-    V.append([scale, -t*scale, 0.])
-
-    # Second rectangle
-    V.append([0., -scale, t*scale])
-    V.append([0., scale, t*scale])
-    V.append([0., -scale, -t*scale])
-    V.append([0., scale, -t*scale])
-
-    # Third rectangle
-    V.append([t*scale, 0., -scale])
-    V.append([t*scale, 0., scale])
-    V.append([-t*scale, 0., -scale])
-    V.append([-t*scale, 0., scale])
-
-    # Building initial triangles
-    F = []
-    # 5 aces around point 0
-    F.append([0, 11, 5])
-    F.append([0, 5, 1])
-    F.append([0, 1, 7])
-    F.append([0, 7, 10])
-    F.append([0, 10, 11])
-    # 5 adjacent faces
-    F.append([1, 5, 9])
-    F.append([5, 11, 4])
-    F.append([11, 10, 2])
-    F.append([10, 7, 6])
-    F.append([7, 1, 8])
-    # 5 aces around point 3
-    F.append([3, 9, 4])
-    F.append([3, 4, 2])
-    F.append([3, 2, 6])
-    F.append([3, 6, 8])
-    F.append([3, 8, 9])
-    # 5 adjacent faces
-    F.append([4, 9, 5])
-    F.append([2, 4, 11])
-    F.append([6, 2, 10])
-    F.append([8, 6, 7])
-    F.append([9, 8, 1])
-
-    # Refining the Icosahedron by subdividing the triangles
-    for _ in range(refining):
-        FRefined = []
-        VRefined = []
-        for i,f in enumerate(F):
-            v0 = V[f[0]]
-            v1 = V[f[1]]
-            v2 = V[f[2]]
-            # V3
-            v3 = [(v0[0] + v1[0]) / 2.0, (v0[1] + v1[1]) / 2.0, (v0[2] + v1[2]) / 2.0]
-            v3_len = np.sqrt(v3[0]**2 + v3[1]**2 + v3[2]**2)
-            # Rescaling of V3
-            v3 = [v3[0]*np.sqrt(t*t+1)*scale / v3_len,
-                  v3[1]*np.sqrt(t*t+1)*scale / v3_len,
-                  v3[2]*np.sqrt(t*t+1)*scale / v3_len]
-            # V4
-            v4 = [(v1[0] + v2[0]) / 2.0, (v1[1] + v2[1]) / 2.0, (v1[2] + v2[2]) / 2.0]
-            v4_len = np.sqrt(v4[0]**2 + v4[1]**2 + v4[2]**2)
-            # Rescaling of V4
-            v4 = [v4[0]*np.sqrt(t*t+1)*scale / v4_len,
-                  v4[1]*np.sqrt(t*t+1)*scale / v4_len,
-                  v4[2]*np.sqrt(t*t+1)*scale / v4_len]
-            # V5
-            v5 = [(v2[0] + v0[0]) / 2.0, (v2[1] + v0[1]) / 2.0, (v2[2] + v0[2]) / 2.0]
-            v5_len = np.sqrt(v5[0]**2 + v5[1]**2 + v5[2]**2)
-            # Rescaling of V5
-            v5 = [v5[0]*np.sqrt(t*t+1)*scale / v5_len,
-                  v5[1]*np.sqrt(t*t+1)*scale / v5_len,
-                  v5[2]*np.sqrt(t*t+1)*scale / v5_len]
-            #v4 = 0.5 * (v1 + v2) / np.linalg.norm(v1 + v2)
-            #v5 = 0.5 * (v2 + v0) / np.linalg.norm(v2 + v0)
-            # Add the new vertices to VRefined
-            VRefined.append(v0)
-            VRefined.append(v1)
-            VRefined.append(v2)
-            VRefined.append(v3)
-            VRefined.append(v4)
-            VRefined.append(v5)
-            # Add the new faces to FRefined
-            idx = i * 6
-            FRefined.append([idx, idx+3, idx+5])
-            FRefined.append([idx+1, idx+4, idx+3])
-            FRefined.append([idx+2, idx+5, idx+4])
-            FRefined.append([idx+3, idx+4, idx+5])
-        V = VRefined
-        F = FRefined
-
-    # Centering it around "center"
-    V = np.array(V)
-    F = np.array(F, dtype=np.int32)
+'''
+The Icosahedron with vertices (+-scale, +-t*scale, 0), t the golden ratio,
+has radius sqrt(t*t+1)*scale.
 
-    return V, F
+@param scale: The scale of the sphere
+@return: the radius of the sphere
+'''
+def sphere_radius(scale):
+    t = (1.0 + np.sqrt(5.0)) / 2.0
+    return np.sqrt(t*t + 1) * scale
 
 '''
 Author: Jens Kanstrup Larsen <jensklmail@yahoo.dk>
@@ -355,32 +373,6 @@ def make_prism(center=(0.,0.,0.), l=1.0, h=1.0, v=45.0):
                   [0,1,4],[0,4,5]], dtype=np.int32)
 
     # Refining the faces by subdividing triangles
-    for _ in range(1):
-        FRefined = []
-        VRefined = []
-        for i,f in enumerate(F):
-            v0 = V[f[0]]
-            v1 = V[f[1]]
-            v2 = V[f[2]]
-            # V3
-            v3 = [(v0[0] + v1[0]) / 2.0, (v0[1] + v1[1]) / 2.0, (v0[2] + v1[2]) / 2.0]
-            v4 = [(v1[0] + v2[0]) / 2.0, (v1[1] + v2[1]) / 2.0, (v1[2] + v2[2]) / 2.0]
-            # V5
-            v5 = [(v2[0] + v0[0]) / 2.0, (v2[1] + v0[1]) / 2.0, (v2[2] + v0[2]) / 2.0]
-            # Add the new vertices to VRefined
-            VRefined.append(v0)
-            VRefined.append(v1)
-            VRefined.append(v2)
-            VRefined.append(v3)
-            VRefined.append(v4)
-            VRefined.append(v5)
-            # Add the new faces to FRefined
-            idx = i * 6
-            FRefined.append([idx, idx+3, idx+5])
-            FRefined.append([idx+1, idx+4, idx+3])
-            FRefined.append([idx+2, idx+5, idx+4])
-            FRefined.append([idx+3, idx+4, idx+5])
-        V = VRefined
-        F = np.array(FRefined, dtype=np.int32)
+    V, F = subdivide(V, F)
 
     return V, F
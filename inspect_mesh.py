@@ -1,36 +1,109 @@
 #!/usr/bin/python3
 import sys, os
-import numpy as np
-# Add pyigl to the path
-PATH_TO_LIBIGL = '/home/max/diku/2018/project2018b2/SoftRoboticDesign/robot_designs/libigl/python'
-sys.path.insert(0, PATH_TO_LIBIGL)
-import pyigl as igl
-from csgxml import parse_csg_graph
-from utils import save_to_stl
+import time
+import argparse
+from csgxml import parse_csg_graph, add_build_arguments, cache_from_args, separation_from_args,\
+                   tessellation_from_args, profiler_from_args, report_profile
+from cache import MemoryCache
+from meshfile import is_mesh_file, load_mesh
 import trimesh
 import stl
 
-if len(sys.argv) < 2:
-    print("Usage: verify_feasibility.py [filename] (Optional: robot name in XML file)")
-    exit()
-
-FNAME = sys.argv[1]
-# Step 0: Load in an XML file robot as CSG
-csg_graph, last_name = parse_csg_graph(FNAME)
-robot_name = last_name
-VLast, FLast = csg_graph[robot_name]
-# Face normals
-FN = igl.eigen.MatrixXd()
-igl.per_face_normals(VLast, FLast, FN)
-
-## Vertices
-V = np.array(VLast)
-## Faces
-F = np.array(FLast, dtype=np.int32)
-## Face Normals
-FN = np.array(FN)
-## Making the mesh
-robot = trimesh.base.Trimesh(V, F, FN)
+parser = argparse.ArgumentParser(description='Inspect a robot designed in a csg xml file')
+parser.add_argument('filename', help='csg xml file, or a binary mesh file (.xmesh)')
+parser.add_argument('robot_name', nargs='?', help='Robot name in XML file (the last solid if not given)')
+parser.add_argument('--watch', action='store_true',
+                    help='Rebuild the robot in the open viewer whenever the file changes')
+parser.add_argument('--poll', type=float, default=0.5, metavar='SECONDS',
+                    help='How often the file is checked for changes in watch mode')
+add_build_arguments(parser)
+args = parser.parse_args()
+
+'''
+Meshes of the solids by node hash, kept from one build to the next. Only the
+solids of the last build are kept, the ones an edit replaced are dropped.
+'''
+class Primitives(dict):
+    def __init__(self):
+        super().__init__()
+        # Keys looked up since the last prune
+        self.used = set()
+
+    def __contains__(self, key):
+        self.used.add(key)
+        return super().__contains__(key)
+
+    # Drops the solids which were not looked up since the last prune
+    def prune(self):
+        for key in set(self) - self.used:
+            del self[key]
+        self.used = set()
+
+FNAME = args.filename
+cache = cache_from_args(args)
+primitives = None
+if args.watch:
+    # The results of earlier builds are kept, so a rebuild only evaluates
+    # the nodes which changed and the nodes depending on them
+    cache = MemoryCache(int(args.cache_size * 2**20), backing=cache)
+    primitives = Primitives()
+
+def build():
+    if is_mesh_file(FNAME):
+        # An already built mesh
+        return load_mesh(FNAME)
+    # Step 0: Load in an XML file robot as CSG
+    profiler = profiler_from_args(args)
+    csg_graph, last_name = parse_csg_graph(FNAME, cache=cache, workers=args.workers,
+                                           separation=separation_from_args(args), keep=[],
+                                           target=args.robot_name, tessellation=tessellation_from_args(args),
+                                           primitives=primitives, profiler=profiler)
+    report_profile(profiler, args)
+    if primitives is not None:
+        primitives.prune()
+    robot_name = last_name
+    return csg_graph[robot_name]
+
+## Making the mesh (vertices, faces and face normals)
+def make_robot(mesh):
+    return trimesh.base.Trimesh(mesh.V, mesh.F, mesh.face_normals())
+
+# Identifies a version of the file, None while it does not exist (editors may replace it)
+def file_stamp():
+    try:
+        stat = os.stat(FNAME)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+stamp = file_stamp()
+robot = make_robot(build())
 
 # Step 1: Show the robot design to the user (using libigl to show triangle mesh)
-robot.show()
+if not args.watch:
+    robot.show()
+else:
+    scene = trimesh.Scene()
+    scene.add_geometry(robot, geom_name='robot')
+
+    # Called by the viewer every 'poll' seconds
+    def update(scene):
+        global stamp
+        current = file_stamp()
+        if current is None or current == stamp:
+            return
+        stamp = current
+        start = time.time()
+        hits = cache.hits
+        try:
+            mesh = build()
+        except Exception as e:
+            # Likely a half written file, the last robot stays on screen
+            print('Build failed: {}'.format(e), file=sys.stderr)
+            return
+        scene.delete_geometry('robot')
+        scene.add_geometry(make_robot(mesh), geom_name='robot')
+        print('Rebuilt in {:.3f}s ({} cached results reused), {} triangles'.format(
+            time.time() - start, cache.hits - hits, len(mesh.F)), file=sys.stderr)
+
+    scene.show(callback=update, callback_period=args.poll)
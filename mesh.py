@@ -0,0 +1,110 @@
+import numpy as np
+
+# Vertices closer than this (in model units) are merged when a mesh is welded
+WELD_TOLERANCE = 1e-9
+
+'''
+Triangle mesh passed through the csg pipeline.
+The vertices are kept as a contiguous float64 np.array (n x 3) and the faces
+as a contiguous int32 np.array (m x 3), so they can be handed to numpy, the
+cache, worker processes and the stl writer without copies. A mesh is never
+modified once created, which lets it cache its bounds. It has no content
+hash: results are cached by the hashes of their csg nodes (cache.node_hash),
+which never need the arrays.
+A mesh unpacks as its vertices and faces: V, F = mesh
+'''
+class Mesh:
+    def __init__(self, V, F):
+        # Only copies if V or F do not have the right type or layout already
+        self.V = np.ascontiguousarray(V, dtype=np.float64).reshape(-1, 3)
+        self.F = np.ascontiguousarray(F, dtype=np.int32).reshape(-1, 3)
+        self._bounds = None
+
+    def __iter__(self):
+        return iter((self.V, self.F))
+
+    @staticmethod
+    def empty():
+        return Mesh(np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32))
+
+    def is_empty(self):
+        return len(self.V) == 0
+
+    '''
+    @return: the corners of the axis aligned bounding box (min, max),
+             both zero for an empty mesh
+    '''
+    @property
+    def bounds(self):
+        if self._bounds is None:
+            if self.is_empty():
+                self._bounds = (np.zeros(3), np.zeros(3))
+            else:
+                self._bounds = (self.V.min(axis=0), self.V.max(axis=0))
+        return self._bounds
+
+    # Center of the axis aligned bounding box
+    @property
+    def center(self):
+        v_min, v_max = self.bounds
+        return (v_min + v_max) / 2.0
+
+    '''
+    Applies a 4x4 affine matrix to the vertices with a single matmul.
+    The faces are shared with the new mesh.
+
+    @param M: 4x4 transformation matrix
+    @return: the transformed mesh
+    '''
+    def transformed(self, M):
+        return Mesh(self.V @ M[:3, :3].T + M[:3, 3], self.F)
+
+    # Unit normals of the faces, degenerate faces get a zero normal
+    def face_normals(self):
+        triangles = self.V[self.F]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        lengths = np.linalg.norm(normals, axis=1)
+        return normals / np.where(lengths > 0, lengths, 1.0)[:, None]
+
+    '''
+    Merges coincident vertices and drops the faces this leaves degenerate or
+    doubled. Vertices are snapped to a grid of the tolerance and deduplicated
+    with np.unique, the first vertex of every grid cell is kept. Faces on the
+    same three vertices facing opposite ways cancel in pairs (like the zero
+    thickness wall where two solids touch), of those facing the same way only
+    the first is kept.
+
+    @param tolerance: Size of the grid cells, 0 merges only equal vertices
+    @return: the welded mesh (this mesh if nothing changed)
+    '''
+    def welded(self, tolerance=WELD_TOLERANCE):
+        if self.is_empty():
+            return self
+        keys = np.floor(self.V / tolerance + 0.5).astype(np.int64) if tolerance > 0 else self.V
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        # Number the merged vertices in the order they first appear
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        first = first[order]
+        F = rank[inverse.reshape(-1)][self.F]
+        F = F[(F[:, 0] != F[:, 1]) & (F[:, 1] != F[:, 2]) & (F[:, 2] != F[:, 0])]
+        # Rotate every face to start at its smallest vertex, the order of the
+        # other two is then its orientation
+        rows = np.arange(len(F))[:, None]
+        rotated = F[rows, (np.argmin(F, axis=1)[:, None] + np.arange(3)) % 3]
+        orientation = np.where(rotated[:, 1] < rotated[:, 2], 1, -1)
+        _, group = np.unique(np.sort(rotated, axis=1), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        # Sum of the orientations of the faces on the same vertices
+        net = np.bincount(group, weights=orientation)[group]
+        candidates = np.flatnonzero((net != 0) & (orientation == np.sign(net)))
+        _, first_faces = np.unique(group[candidates], return_index=True)
+        F = F[np.sort(candidates[first_faces])]
+        if len(first) == len(self.V) and len(F) == len(self.F):
+            return self
+        # Drop the vertices no face uses anymore, keeping their order
+        used = np.unique(F)
+        remap = np.full(len(first), -1)
+        remap[used] = np.arange(len(used))
+        return Mesh(self.V[first[used]], remap[F])
@@ -0,0 +1,85 @@
+import os
+import struct
+import numpy as np
+from mesh import Mesh
+
+'''
+Binary mesh files (.xmesh): a 64 byte header followed by the raw vertex and
+face arrays, each starting at a multiple of 64 bytes, so they are loaded by
+memory mapping the file instead of parsing it.
+
+Header (little endian):
+    magic         8 bytes   b'XMESH\0\0\0'
+    version       uint32
+    reserved      uint32
+    vertices      uint64    number of vertices n
+    faces         uint64    number of faces m
+    V offset      uint64    offset of V, float64 (n x 3)
+    F offset      uint64    offset of F, int32 (m x 3)
+    (zero padding up to 64 bytes)
+'''
+MAGIC = b'XMESH\0\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+ALIGNMENT = 64
+EXTENSION = '.xmesh'
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def is_mesh_file(fname):
+    return fname.lower().endswith(EXTENSION)
+
+'''
+Saves a mesh as a binary mesh file. The file is written next to its target
+and then moved over it, so saving a mesh loaded (memory mapped) from the same
+file is safe and readers never see a half written file.
+
+@param fname: Name of the file
+@param mesh: The Mesh to save
+'''
+def save_mesh(fname, mesh):
+    V = np.ascontiguousarray(mesh.V, dtype='<f8')
+    F = np.ascontiguousarray(mesh.F, dtype='<i4')
+    v_offset = aligned(HEADER.size)
+    f_offset = aligned(v_offset + V.nbytes)
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, 0, len(V), len(F), v_offset, f_offset).ljust(v_offset, b'\0'))
+            V.tofile(fh)
+            fh.write(b'\0' * (f_offset - v_offset - V.nbytes))
+            F.tofile(fh)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+'''
+Loads a binary mesh file. With mmap the arrays of the mesh are read-only
+views of the mapped file, so only the parts which are used get read.
+
+@param fname: Name of the file
+@param mmap: Memory map the file, else it is read into memory
+@return: the Mesh
+'''
+def load_mesh(fname, mmap=True):
+    with open(fname, 'rb') as fh:
+        header = fh.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError("'{}' is not a mesh file".format(fname))
+    magic, version, _, n, m, v_offset, f_offset = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("'{}' is not a mesh file".format(fname))
+    if version != VERSION:
+        raise ValueError("Mesh file '{}' has unsupported version {}".format(fname, version))
+
+    def read(dtype, offset, count):
+        # Empty files can not be mapped
+        if count == 0:
+            return np.zeros((0, 3), dtype=dtype)
+        if mmap:
+            return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(count, 3))
+        return np.fromfile(fname, dtype=dtype, count=3 * count, offset=offset).reshape(-1, 3)
+    return Mesh(read('<f8', v_offset, n), read('<i4', f_offset, m))
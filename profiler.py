@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import json
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not recorded
+    resource = None
+
+# Peak resident set size of this process in KB, None if it is unknown
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+# Kind of a csg node, like 'binary_op:difference' or 'solid:sphere'
+def node_kind(element):
+    return '{}:{}'.format(element.tag, element.attrib.get('shape', element.attrib.get('type', '')))
+
+'''
+Runs function(*args) and measures it, this is used in the worker processes.
+
+@return: the result and its timing (start, seconds, peak rss delta in KB, pid)
+'''
+def measure(function, *args):
+    rss = peak_rss()
+    start = time.time()
+    result = function(*args)
+    seconds = time.time() - start
+    rss_delta = peak_rss() - rss if rss is not None else None
+    return result, (start, seconds, rss_delta, os.getpid())
+
+'''
+Records where the time of evaluating a csg graph goes.
+Every evaluated node gets a record with its wall time, the vertex and face
+counts of its operands and result, the growth of the peak resident set size
+of the process evaluating it and the path it took: 'cgal', a fast path
+('aabb'/'obb'), 'cache', 'primitives' (a solid shared with an earlier
+build) or None for the plain evaluation of a solid or unary operation.
+'''
+class Profiler:
+    def __init__(self, records=None):
+        self.records = records if records is not None else []
+        # Records of the nodes being evaluated, by index
+        self.pending = {}
+
+    '''
+    Starts the record of a node.
+
+    @param node: The CSGNode being evaluated
+    @param inputs: The meshes of its operands
+    '''
+    def begin(self, node, inputs):
+        self.pending[node.index] = {'name': node.name, 'kind': node_kind(node.element),
+                                    'inputs': [[len(mesh.V), len(mesh.F)] for mesh in inputs],
+                                    'start': time.time(), 'rss': peak_rss()}
+
+    '''
+    Finishes the record of a node.
+
+    @param node: The CSGNode which was evaluated
+    @param mesh: Its resulting mesh
+    @param path: How it was evaluated
+    @param timing: (start, seconds, rss delta, pid) if it was measured elsewhere (see measure)
+    '''
+    def end(self, node, mesh, path=None, timing=None):
+        record = self.pending.pop(node.index, None)
+        if record is None:
+            return
+        rss = record.pop('rss')
+        if timing is None:
+            seconds = time.time() - record['start']
+            rss_delta = peak_rss() - rss if rss is not None else None
+            timing = (record['start'], seconds, rss_delta, os.getpid())
+        record['start'], record['seconds'], record['rss_delta_kb'], record['pid'] = timing
+        record['vertices'] = len(mesh.V)
+        record['faces'] = len(mesh.F)
+        record['path'] = path
+        self.records.append(record)
+
+    # The n slowest nodes
+    def hottest(self, n=10):
+        return sorted(self.records, key=lambda record: -record['seconds'])[:n]
+
+    '''
+    @param n: Number of nodes in the table
+    @return: table of the n slowest nodes (as str)
+    '''
+    def table(self, n=10):
+        records = self.hottest(n)
+        width = max([len(record['name']) for record in records] + [4])
+        lines = ['{:>9} {:<{w}} {:<22} {:<10} {:>10} {:>10} {:>9}'.format(
+            'seconds', 'node', 'kind', 'path', 'in faces', 'faces', 'rss MB', w=width)]
+        for record in records:
+            rss = record['rss_delta_kb']
+            lines.append('{:>9.3f} {:<{w}} {:<22} {:<10} {:>10} {:>10} {:>9}'.format(
+                record['seconds'], record['name'], record['kind'], str(record['path']),
+                sum(faces for _, faces in record['inputs']), record['faces'],
+                '-' if rss is None else '{:.1f}'.format(rss / 1024.), w=width))
+        lines.append('{} nodes, {:.3f}s in total'.format(len(self.records),
+                                                         sum(record['seconds'] for record in self.records)))
+        return '\n'.join(lines)
+
+    def save_json(self, fname):
+        with open(fname, 'w') as fh:
+            json.dump({'nodes': self.records}, fh, indent=2)
+
+    '''
+    Saves the records in the Chrome trace event format (chrome://tracing,
+    Perfetto). Every process evaluating nodes gets its own track.
+    '''
+    def save_chrome_trace(self, fname):
+        origin = min((record['start'] for record in self.records), default=0.)
+        events = []
+        for record in self.records:
+            events.append({'name': record['name'], 'cat': record['kind'], 'ph': 'X',
+                           'ts': (record['start'] - origin) * 1e6, 'dur': record['seconds'] * 1e6,
+                           'pid': record['pid'], 'tid': record['pid'],
+                           'args': {'path': record['path'], 'inputs': record['inputs'],
+                                    'vertices': record['vertices'], 'faces': record['faces'],
+                                    'rss_delta_kb': record['rss_delta_kb']}})
+        with open(fname, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
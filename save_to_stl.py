@@ -1,22 +1,35 @@
 #!/usr/bin/python3
 import sys, os
-import numpy as np
+import argparse
 # Add pyigl to the path
-from csgxml import parse_csg_graph
-from utils import save_to_stl
+from csgxml import parse_csg_graph, add_build_arguments, cache_from_args, separation_from_args,\
+                   tessellation_from_args, profiler_from_args, report_profile, prepare_export, export_from_args,\
+                   save_result
+from meshfile import is_mesh_file, load_mesh
 import trimesh
 import stl
 
-FNAME = sys.argv[1]
-# Step 0: Load in an XML file robot as CSG
-csg_graph, last_name = parse_csg_graph(FNAME)
-robot_name = last_name
-VLast, FLast = csg_graph[robot_name]
-# Face normals
+parser = argparse.ArgumentParser(description='Save a solid of a csg xml file as an stl file')
+parser.add_argument('filename', help='csg xml file, or a binary mesh file (.xmesh)')
+parser.add_argument('stl_name', help='stl file, or a binary mesh file (.xmesh)')
+parser.add_argument('--target', help='Name of the solid to save (the last one if not given)')
+add_build_arguments(parser)
+args = parser.parse_args()
 
-## Vertices
-V = np.array(VLast)
-## Faces
-F = np.array(FLast, dtype=np.int32)
+FNAME = args.filename
+if is_mesh_file(FNAME):
+    # An already built mesh
+    mesh = load_mesh(FNAME)
+else:
+    # Step 0: Load in an XML file robot as CSG
+    profiler = profiler_from_args(args)
+    csg_graph, last_name = parse_csg_graph(FNAME, cache=cache_from_args(args), workers=args.workers,
+                                           separation=separation_from_args(args), keep=[],
+                                           target=args.target, tessellation=tessellation_from_args(args),
+                                           profiler=profiler)
+    report_profile(profiler, args)
+    robot_name = last_name
+    mesh = csg_graph[robot_name]
+robot = prepare_export(mesh, **export_from_args(args))
 
-save_to_stl(sys.argv[2], V, F)
+save_result(args.stl_name, robot)
@@ -1,21 +1,74 @@
+import pickle
+import weakref
 import numpy as np
+from functools import reduce
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 
-# A grid is always created based on a Signed Distance Field 'phi'
+# A grid is always created based on a Signed Distance Field 'phi'.
+# With a band the grid is stored narrow-band: only bricks of brick_size^3 nodes
+# that may hold a node with |phi| <= band are allocated, all other nodes read
+# as +-band. Values inside allocated bricks are clamped to [-band, band] too.
 class Grid:
     def __getitem__(grid, grid_point):
-        for ii in range(grid.m_I):
-            if grid.m_min_coord[0] + grid.m_delta[0] * ii == grid_point[0]:
-                break
-        for jj in range(grid.m_J):
-            if grid.m_min_coord[1] + grid.m_delta[1] * jj == grid_point[1]:
-                break
-        for kk in range(grid.m_K):
-            if grid.m_min_coord[2] + grid.m_delta[2] * kk == grid_point[2]:
-                break
-        return grid.values[(kk*grid.m_J + jj)*grid.m_I + ii]
-
-
-    def __init__(self, m_min_coord, m_max_coord, m_I, m_J, m_K, values=None, phi=None):
+        ii, jj, kk = grid.lattice_index(grid_point)
+        if grid.band is None:
+            return grid.values[(kk*grid.m_J + jj)*grid.m_I + ii]
+        return np.atleast_1d(grid.node_values(ii, jj, kk))
+
+    # The (ii, jj, kk) lattice index of a grid node (or an (N,3) batch of nodes)
+    def lattice_index(self, grid_point):
+        t = (np.asarray(grid_point, dtype=np.float64) - self.m_min_coord) / self.m_delta
+        index = np.rint(t)
+        shape = np.array([self.m_I, self.m_J, self.m_K])
+        if np.any(np.abs(t - index) > 1e-6) or np.any(index < 0) or np.any(index >= shape):
+            raise IndexError("Point {} is not a node of the grid".format(grid_point))
+        index = index.astype(np.int64)
+        return index[..., 0], index[..., 1], index[..., 2]
+
+    # Trilinear interpolation of the grid values at the points (N,3).
+    # Points outside the grid are either clamped to the boundary ('clamp') or
+    # given the value NaN ('nan')
+    def sample(self, points, outside='clamp'):
+        if outside not in ('clamp', 'nan'):
+            raise Exception("Unknown outside policy '{}'".format(outside))
+        points = np.asarray(points, dtype=np.float64)
+        shape = np.array([self.m_I, self.m_J, self.m_K])
+        t = (points.reshape(-1, 3) - self.m_min_coord) / self.m_delta
+        out_of_bounds = np.any((t < 0) | (t > shape - 1), axis=1)
+        t = np.clip(t, 0, shape - 1)
+        # Lower corner of the enclosing cell, the last node belongs to the last cell
+        index = np.minimum(np.floor(t).astype(np.int64), np.maximum(shape - 2, 0))
+        w = t - index
+        ii, jj, kk = index[:, 0], index[:, 1], index[:, 2]
+        wx, wy, wz = w[:, 0], w[:, 1], w[:, 2]
+        values = self.node_values
+        # Interpolate along x, then y, then z
+        c00 = values(ii, jj, kk) * (1 - wx) + values(ii+1, jj, kk) * wx
+        c10 = values(ii, jj+1, kk) * (1 - wx) + values(ii+1, jj+1, kk) * wx
+        c01 = values(ii, jj, kk+1) * (1 - wx) + values(ii+1, jj, kk+1) * wx
+        c11 = values(ii, jj+1, kk+1) * (1 - wx) + values(ii+1, jj+1, kk+1) * wx
+        c0 = c00 * (1 - wy) + c10 * wy
+        c1 = c01 * (1 - wy) + c11 * wy
+        result = c0 * (1 - wz) + c1 * wz
+        if outside == 'nan':
+            result[out_of_bounds] = np.nan
+        return result.reshape(points.shape[:-1])
+
+    # Values of the nodes with lattice indices (ii, jj, kk), works on index arrays
+    def node_values(self, ii, jj, kk):
+        if self.band is None:
+            return self.values[(kk*self.m_J + jj)*self.m_I + ii, 0]
+        B = self.brick_size
+        brick = self.brick_index[kk // B, jj // B, ii // B]
+        fill = self.brick_sign[kk // B, jj // B, ii // B] * self.band
+        if self.brick_values.shape[0] == 0:
+            return fill.astype(np.float64)
+        stored = self.brick_values[np.maximum(brick, 0), kk % B, jj % B, ii % B]
+        return np.where(brick >= 0, stored, fill)
+
+    def __init__(self, m_min_coord, m_max_coord, m_I, m_J, m_K, values=None, phi=None,
+                 band=None, brick_size=8):
         self.m_min_coord = m_min_coord # Vector3 coord
         self.m_max_coord = m_max_coord # Vector3 coord
         self.m_I = m_I # Number of nodes along x_axis
@@ -24,43 +77,309 @@ class Grid:
         self.m_delta = [(m_max_coord[0]-m_min_coord[0])/(m_I-1.0),
                         (m_max_coord[1]-m_min_coord[1])/(m_J-1.0),
                         (m_max_coord[2]-m_min_coord[2])/(m_K-1.0)] # Spacing between nodes
-        if values is None:
+        self.band = band # Half width of the narrow band, None for a dense grid
+        self.brick_size = brick_size
+        if band is not None:
+            self.values = None
+            shape = self.brick_shape()
+            self.brick_index = np.full(shape, -1, dtype=np.int32) # Brick number, -1 if not allocated
+            self.brick_sign = np.ones(shape, dtype=np.int8) # Sign of the nodes of unallocated bricks
+            self.brick_values = np.zeros((0, brick_size, brick_size, brick_size))
+        elif values is None:
             self.values = np.zeros((self.m_I * self.m_J * self.m_K, 1))
         else:
             self.values = values
         self.phi = phi
 
-    # Fill out self.value?
-    def create(self, phi):
+    # Fill out self.values by evaluating phi on whole batches of lattice nodes.
+    # The lattice is walked in z-slabs so every batch stays cache sized.
+    # With workers > 1 the z-slabs of a dense grid are split between processes
+    # which write straight into shared memory. phi is pickled to the workers,
+    # an Expr tree pickles without its compiled program and a phi which can
+    # not be pickled (like a lambda) is evaluated in this process.
+    def create(self, phi, batch_size=1 << 16, workers=1):
         self.phi = phi
-        for ii in range(self.m_I):
-            for jj in range(self.m_J):
-                for kk in range(self.m_K):
-                    idx = (kk*self.m_J + jj)*self.m_I + ii
-                    self.values[idx] =\
-                            phi(np.array([self.m_min_coord[0] + self.m_delta[0] * ii,
-                                          self.m_min_coord[1] + self.m_delta[1] * jj,
-                                          self.m_min_coord[2] + self.m_delta[2] * kk]))
+        if self.band is not None:
+            self.create_narrow_band(phi, batch_size)
+            return
+        if workers > 1 and self.m_K > 1 and picklable(phi):
+            self.create_parallel(phi, batch_size, workers)
+            return
+        values = np.empty(self.m_I * self.m_J * self.m_K)
+        self.fill_slabs(values, phi, 0, self.m_K, batch_size)
+        self.values = values.reshape(-1, 1)
 
-def sphere(delta):
-    return lambda p: np.sqrt((p**2)) - delta
+    # Writes phi at the nodes of the z-slabs [k_begin, k_end) into the flat array values
+    def fill_slabs(self, values, phi, k_begin, k_end, batch_size):
+        slab = self.m_I * self.m_J
+        step = max(1, batch_size // slab)
+        for kk in range(k_begin, k_end, step):
+            kk_end = min(kk + step, k_end)
+            values[kk*slab:kk_end*slab] = phi(self.nodes(kk, kk_end))
 
-def box(w, h, d):
-    def corner_check_return(p):
-        if p[0] > 0 and p[1] > 0 and p[2] > 0:
-            return np.sqrt(np.dot(p.T, p))
+    # Evaluates the z-slabs in a pool of processes, a few slabs per process
+    # to even out slabs of uneven cost. The values stay in the shared memory
+    # block, without a copy. The block is closed once the values array is
+    # freed (every view of it refers to it), numpy does not keep the block
+    # mapped by itself.
+    def create_parallel(self, phi, batch_size, workers):
+        n = self.m_I * self.m_J * self.m_K
+        shm = shared_memory.SharedMemory(create=True, size=n * 8)
+        try:
+            geometry = (self.m_min_coord, self.m_max_coord, self.m_I, self.m_J, self.m_K)
+            bounds = np.linspace(0, self.m_K, min(self.m_K, 4 * workers) + 1).astype(int)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(fill_shared_slabs, shm.name, geometry, phi, k_begin, k_end, batch_size)
+                           for k_begin, k_end in zip(bounds[:-1], bounds[1:])]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        # Only the mapping of this process is left, the memory is freed once it is closed
+        shm.unlink()
+        self.values = np.ndarray((n, 1), dtype=np.float64, buffer=shm.buf)
+        weakref.finalize(self.values, shm.close)
+
+    # Number of bricks along (z, y, x)
+    def brick_shape(self):
+        B = self.brick_size
+        return (-(-self.m_K // B), -(-self.m_J // B), -(-self.m_I // B))
+
+    # Evaluates phi at the brick centers and only fills the bricks that can
+    # reach the band. This assumes phi is 1-Lipschitz, like a true distance.
+    def create_narrow_band(self, phi, batch_size):
+        B = self.brick_size
+        delta = np.asarray(self.m_delta, dtype=np.float64)
+        nbk, nbj, nbi = self.brick_shape()
+        bk, bj, bi = np.meshgrid(np.arange(nbk), np.arange(nbj), np.arange(nbi), indexing='ij')
+        origins = np.stack([bi.ravel(), bj.ravel(), bk.ravel()], axis=1) * B
+        centers = self.m_min_coord + (origins + (B - 1) / 2.0) * delta
+        half_diagonal = np.linalg.norm((B - 1) / 2.0 * delta)
+        center_values = np.concatenate([phi(centers[i:i+batch_size])
+                                        for i in range(0, len(centers), batch_size)])
+        allocated = np.abs(center_values) <= self.band + half_diagonal
+        self.brick_sign = np.where(center_values < 0, -1, 1).astype(np.int8).reshape(nbk, nbj, nbi)
+        self.brick_index = np.full(nbk * nbj * nbi, -1, dtype=np.int32)
+        self.brick_index[allocated] = np.arange(np.count_nonzero(allocated), dtype=np.int32)
+        self.brick_index = self.brick_index.reshape(nbk, nbj, nbi)
+        # Local node offsets of a brick, x varies fastest like the dense layout
+        lk, lj, li = np.meshgrid(np.arange(B), np.arange(B), np.arange(B), indexing='ij')
+        local = np.stack([li.ravel(), lj.ravel(), lk.ravel()], axis=1)
+        origins = origins[allocated]
+        self.brick_values = np.empty((len(origins), B, B, B))
+        step = max(1, batch_size // B**3)
+        for b in range(0, len(origins), step):
+            index = (origins[b:b+step, None, :] + local[None, :, :]).reshape(-1, 3)
+            values = phi(self.m_min_coord + index * delta)
+            self.brick_values[b:b+step] = np.clip(values, -self.band, self.band).reshape(-1, B, B, B)
+
+    # The values of all nodes as a dense (I*J*K, 1) array
+    def to_dense(self):
+        if self.band is None:
+            return self.values
+        kk, jj, ii = np.meshgrid(np.arange(self.m_K), np.arange(self.m_J), np.arange(self.m_I),
+                                 indexing='ij')
+        return self.node_values(ii.ravel(), jj.ravel(), kk.ravel()).reshape(-1, 1)
+
+    # The lattice nodes of the z-slabs [k_begin, k_end) as an (n, 3) array,
+    # ordered like self.values
+    def nodes(self, k_begin=0, k_end=None):
+        if k_end is None:
+            k_end = self.m_K
+        xs = self.m_min_coord[0] + self.m_delta[0] * np.arange(self.m_I)
+        ys = self.m_min_coord[1] + self.m_delta[1] * np.arange(self.m_J)
+        zs = self.m_min_coord[2] + self.m_delta[2] * np.arange(k_begin, k_end)
+        # x varies fastest, matching idx = (kk*J + jj)*I + ii
+        Z, Y, X = np.meshgrid(zs, ys, xs, indexing='ij')
+        return np.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=1)
+
+# Whether phi can be sent to worker processes
+def picklable(phi):
+    try:
+        pickle.dumps(phi)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+# Fills the z-slabs [k_begin, k_end) of the values in the shared memory block
+# 'name', this is run in the worker processes of Grid.create
+def fill_shared_slabs(name, geometry, phi, k_begin, k_end, batch_size):
+    m_min_coord, m_max_coord, m_I, m_J, m_K = geometry
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        values = np.ndarray(m_I * m_J * m_K, dtype=np.float64, buffer=shm.buf)
+        Grid(m_min_coord, m_max_coord, m_I, m_J, m_K, values=values.reshape(-1, 1)).fill_slabs(
+            values, phi, k_begin, k_end, batch_size)
+        del values
+    finally:
+        shm.close()
+
+# All signed distance functions take a point (3,) or a batch of points (N,3)
+# and return one distance per point. They are built as expression trees (Expr)
+# which are compiled once into a flat program working on whole point batches.
+class Expr:
+    def __init__(self, op, children=(), params=None):
+        self.op = op # 'sphere', 'box', 'cylinder', 'func', 'min', 'max', 'diff' or 'transform'
+        self.children = list(children)
+        self.params = params
+        self.program = None
+        self.buffers = {}
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        points = np.ascontiguousarray(x.reshape(-1, 3))
+        if self.program is None:
+            self.program = compile_expr(self)
+        result = run_program(self.program, points, self.scratch(points.shape[0]))
+        # The result lives in a reused buffer, so hand out a copy
+        return result.copy().reshape(x.shape[:-1])
+
+    # The compiled program and the scratch buffers are left out when an
+    # expression is pickled (for worker processes), they are rebuilt on use
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['program'] = None
+        state['buffers'] = {}
+        return state
+
+    # Scratch buffers of the program for batches of n points, reused between calls
+    def scratch(self, n):
+        if n not in self.buffers:
+            if len(self.buffers) > 2:
+                self.buffers.clear()
+            n_points, n_values = self.program[1], self.program[2]
+            self.buffers[n] = ([None] + [np.empty((n, 3)) for _ in range(n_points - 1)],
+                               [np.empty(n) for _ in range(n_values)],
+                               np.empty((n, 3)))
+        return self.buffers[n]
+
+def as_expr(phi):
+    return phi if isinstance(phi, Expr) else Expr('func', params=phi)
+
+# phi(x) = a * child(M x + b) + c. Consecutive transforms are folded into one.
+def transform(child, M=None, b=None, a=1.0, c=0.0):
+    M = np.eye(3) if M is None else np.asarray(M, dtype=np.float64)
+    b = np.zeros(3) if b is None else np.asarray(b, dtype=np.float64)
+    child = as_expr(child)
+    if child.op == 'transform':
+        M1, b1, a1, c1 = child.params
+        return Expr('transform', child.children, (M1 @ M, M1 @ b + b1, a * a1, a * c1 + c))
+    return Expr('transform', [child], (M, b, a, c))
+
+# Compiles an expression tree into (instructions, #point registers, #value registers, result register).
+# Point register 0 holds the input points. Registers are recycled as soon as
+# their subtree has been consumed, so a program needs O(depth) buffers.
+def compile_expr(root):
+    instructions = []
+    free_points, free_values = [], []
+    counts = [1, 0]
+
+    def alloc(free, kind):
+        if free:
+            return free.pop()
+        counts[kind] += 1
+        return counts[kind] - 1
+
+    def emit(node, p):
+        if node.op in ('sphere', 'box', 'cylinder', 'func'):
+            v = alloc(free_values, 1)
+            instructions.append((node.op, v, p, node.params))
+            return v
+        if node.op in ('min', 'max', 'diff'):
+            v = emit(node.children[0], p)
+            w = emit(node.children[1], p)
+            instructions.append((node.op, v, w))
+            free_values.append(w)
+            return v
+        if node.op == 'transform':
+            M, b, a, c = node.params
+            if np.array_equal(M, np.eye(3)) and not np.any(b):
+                v = emit(node.children[0], p)
+            else:
+                q = alloc(free_points, 0)
+                instructions.append(('points', q, p, M.T.copy(), b))
+                v = emit(node.children[0], q)
+                free_points.append(q)
+            if a != 1.0 or c != 0.0:
+                instructions.append(('affine', v, a, c))
+            return v
+        raise Exception("Unknown signed distance operation '{}'".format(node.op))
+
+    result = emit(root, 0)
+    return instructions, counts[0], counts[1], result
+
+# Writes the corner check of the columns of q into out: outside a corner the
+# distance is the euclidean one, otherwise the largest component
+def corner_check(q, out):
+    components = [q[:, i] for i in range(q.shape[1])]
+    outside = reduce(np.logical_and, [c > 0 for c in components])
+    np.einsum('ij,ij->i', q, q, out=out)
+    np.sqrt(out, out=out)
+    np.copyto(out, reduce(np.maximum, components), where=~outside)
+
+def eval_sphere(P, out, scratch, delta):
+    np.einsum('ij,ij->i', P, P, out=out)
+    np.sqrt(out, out=out)
+    out -= delta
+
+def eval_box(P, out, scratch, size):
+    np.abs(P, out=scratch)
+    scratch -= size
+    corner_check(scratch, out)
+
+def eval_cylinder(P, out, scratch, params):
+    h, r = params
+    np.hypot(P[:, 0], P[:, 1], out=scratch[:, 0])
+    scratch[:, 0] -= r
+    np.subtract(P[:, 2], h/2., out=scratch[:, 1])
+    corner_check(scratch[:, :2], out)
+
+def eval_func(P, out, scratch, phi):
+    out[:] = phi(P)
+
+primitives = {'sphere': eval_sphere,
+              'box': eval_box,
+              'cylinder': eval_cylinder,
+              'func': eval_func}
+
+def run_program(program, points, buffers):
+    instructions, _, _, result = program
+    P, values, scratch = buffers
+    P[0] = points
+    for instruction in instructions:
+        op = instruction[0]
+        if op == 'min':
+            np.minimum(values[instruction[1]], values[instruction[2]], out=values[instruction[1]])
+        elif op == 'max':
+            np.maximum(values[instruction[1]], values[instruction[2]], out=values[instruction[1]])
+        elif op == 'diff':
+            # max(A(x), -B(x))
+            np.negative(values[instruction[2]], out=values[instruction[2]])
+            np.maximum(values[instruction[1]], values[instruction[2]], out=values[instruction[1]])
+        elif op == 'points':
+            _, q, p, MT, b = instruction
+            np.dot(P[p], MT, out=P[q])
+            P[q] += b
+        elif op == 'affine':
+            _, v, a, c = instruction
+            values[v] *= a
+            values[v] += c
         else:
-            return np.max(p)
+            _, v, p, params = instruction
+            primitives[op](P[p], values[v], scratch, params)
+    P[0] = None
+    return values[result]
 
-    return lambda x: corner_check_return(np.array([np.abs(x[0])-w, np.abs(x[1])-h,np.abs(x[2])-d]))
+def sphere(delta):
+    return Expr('sphere', params=delta)
+
+def box(w, h, d):
+    return Expr('box', params=np.array([w, h, d], dtype=np.float64))
 
 def cylinder(h, r):
-    def corner_check_return(p):
-        if p[0] > 0 and p[1] > 0:
-            return np.sqrt(np.dot(p.T, p))
-        else:
-            return max(p)
-    return lambda x: corner_check_return(np.array([np.sqrt(x[0]**2 + x[1]**2) - r, x[2]-h/2.]))
+    return Expr('cylinder', params=(h, r))
 
 def union(A, B):
     # Assert that dimensions match
@@ -73,8 +392,8 @@ def union(A, B):
     I = A.m_I
     J = A.m_J
     K = A.m_K
-    phi = lambda x: min(A.phi(x), B.phi(x)) # Union => min(A(x), B(x))
-    C = Grid(min_coord, max_coord, I, J, K, phi=phi)
+    phi = Expr('min', [as_expr(A.phi), as_expr(B.phi)]) # Union => min(A(x), B(x))
+    C = Grid(min_coord, max_coord, I, J, K, phi=phi, band=A.band, brick_size=A.brick_size)
     return C
 
 def intersection(A, B):
@@ -88,8 +407,8 @@ def intersection(A, B):
     I = A.m_I
     J = A.m_J
     K = A.m_K
-    phi = lambda x: max(A.phi(x), B.phi(x)) # Intersection => max(A(x), B(x))
-    C = Grid(min_coord, max_coord, I, J, K, phi=phi)
+    phi = Expr('max', [as_expr(A.phi), as_expr(B.phi)]) # Intersection => max(A(x), B(x))
+    C = Grid(min_coord, max_coord, I, J, K, phi=phi, band=A.band, brick_size=A.brick_size)
     return C
 
 def difference(A, B):
@@ -103,36 +422,40 @@ def difference(A, B):
     I = A.m_I
     J = A.m_J
     K = A.m_K
-    phi = lambda x: max(A.phi(x), - B.phi(x)) # Difference => max(A(x), - B(x))
-    C = Grid(min_coord, max_coord, I, J, K, phi=phi)
+    phi = Expr('diff', [as_expr(A.phi), as_expr(B.phi)]) # Difference => max(A(x), - B(x))
+    C = Grid(min_coord, max_coord, I, J, K, phi=phi, band=A.band, brick_size=A.brick_size)
     return C
 
 def translate(A, t):
     min_coord = A.m_min_coord - np.array(t)
     max_coord = A.m_max_coord - np.array(t)
-    phi = lambda x: A.phi(x - np.array(t))
-    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi)
+    phi = transform(A.phi, b=-np.array(t, dtype=np.float64)) # A(x - t)
+    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi,
+             band=A.band, brick_size=A.brick_size)
     return C
 
 def scale(A, s):
     min_coord = A.m_min_coord
     max_coord = A.m_max_coord
-    phi = lambda x: s * A.phi(np.array(x) / s)
-    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi)
+    phi = transform(A.phi, M=np.eye(3) / s, a=s) # s * A(x / s)
+    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi,
+             band=A.band, brick_size=A.brick_size)
     return C
 
 def rotate(A, R):
     min_coord = A.m_min_coord
     max_coord = A.m_max_coord
-    phi = lambda x: A.phi(np.dot(R.T, np.array(x)))
-    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi)
+    phi = transform(A.phi, M=np.asarray(R).T) # A(R^T x)
+    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi,
+             band=A.band, brick_size=A.brick_size)
     return C
 
 def erosion(A, delta):
     min_coord = A.m_min_coord
     max_coord = A.m_max_coord
-    phi = lambda x: A.phi(x) - delta
-    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi)
+    phi = transform(A.phi, c=-delta) # A(x) - delta
+    C = Grid(min_coord, max_coord, A.m_I, A.m_J, A.m_K, phi=phi,
+             band=A.band, brick_size=A.brick_size)
     return C
 
 def dilation(A, delta):
@@ -0,0 +1,81 @@
+import numpy as np
+from signed_distance_factory import Grid
+
+# Corner offsets of a cell, x varies fastest like the Grid layout
+CORNERS = np.array([[0,0,0],[1,0,0],[0,1,0],[1,1,0],
+                    [0,0,1],[1,0,1],[0,1,1],[1,1,1]], dtype=np.int64)
+
+# An adaptive octree over a Signed Distance Field 'phi'.
+# A cell is only subdivided when |phi(center)| <= half its diagonal, i.e. when
+# it may contain the surface (assuming phi is 1-Lipschitz). All other cells
+# become leaves holding their center value.
+class Octree:
+    def __init__(self, m_min_coord, m_max_coord, max_depth):
+        self.m_min_coord = np.asarray(m_min_coord, dtype=np.float64) # Vector3 coord
+        self.m_max_coord = np.asarray(m_max_coord, dtype=np.float64) # Vector3 coord
+        self.max_depth = max_depth
+        self.m_N = 2**max_depth # Number of finest cells along every axis
+        self.m_delta = (self.m_max_coord - self.m_min_coord) / self.m_N # Size of the finest cells
+        self.phi = None
+        # Leaves away from the surface: origin (in finest cells), size (in finest cells) and center value
+        self.leaf_origin = np.zeros((0, 3), dtype=np.int64)
+        self.leaf_size = np.zeros(0, dtype=np.int64)
+        self.leaf_value = np.zeros(0)
+        # Finest cells that may contain the surface and the values at their 8 corners
+        self.surface_origin = np.zeros((0, 3), dtype=np.int64)
+        self.surface_values = np.zeros((0, 8))
+        self.evaluations = 0 # Number of points phi was evaluated at
+
+    def create(self, phi):
+        self.phi = phi
+        self.evaluations = 0
+        origins = [np.zeros((1, 3), dtype=np.int64)]
+        sizes, values = [], []
+        active = origins[0]
+        size = self.m_N
+        # Refine level by level, every level is a single batched evaluation
+        while size > 1 and len(active) > 0:
+            centers = self.m_min_coord + (active + size / 2.0) * self.m_delta
+            center_values = phi(centers)
+            self.evaluations += len(centers)
+            near = np.abs(center_values) <= np.linalg.norm(size / 2.0 * self.m_delta)
+            origins.append(active[~near])
+            sizes.append(np.full(np.count_nonzero(~near), size, dtype=np.int64))
+            values.append(center_values[~near])
+            size //= 2
+            active = (active[near, None, :] + CORNERS[None, :, :] * size).reshape(-1, 3)
+        self.leaf_origin = np.concatenate(origins[1:] + [np.zeros((0, 3), dtype=np.int64)])
+        self.leaf_size = np.concatenate(sizes + [np.zeros(0, dtype=np.int64)])
+        self.leaf_value = np.concatenate(values + [np.zeros(0)])
+        # Evaluate the corners of the surface cells, shared corners only once
+        corners = (active[:, None, :] + CORNERS[None, :, :]).reshape(-1, 3)
+        n = self.m_N + 1
+        keys, inverse = np.unique((corners[:, 2] * n + corners[:, 1]) * n + corners[:, 0],
+                                  return_inverse=True)
+        nodes = np.stack([keys % n, (keys // n) % n, keys // (n * n)], axis=1)
+        node_values = phi(self.m_min_coord + nodes * self.m_delta) if len(nodes) else np.zeros(0)
+        self.evaluations += len(nodes)
+        self.surface_origin = active
+        self.surface_values = node_values[inverse.ravel()].reshape(-1, 8)
+
+    # The surface cells for a mesher: the coordinates of their lower corners,
+    # their size (Vector3) and the values at their 8 corners (ordered like CORNERS)
+    def surface_cells(self):
+        return self.m_min_coord + self.surface_origin * self.m_delta, self.m_delta, self.surface_values
+
+    # Exports the octree to a uniform Grid with 2^max_depth + 1 nodes per axis.
+    # Nodes of the surface cells hold exact values, nodes only covered by
+    # coarser leaves hold the value at the center of that leaf (which has the right sign).
+    def to_grid(self):
+        n = self.m_N + 1
+        values = np.zeros((n, n, n))
+        # Coarse leaves first, largest first, so the exact values of smaller cells win
+        for level_size in np.unique(self.leaf_size)[::-1]:
+            on_level = self.leaf_size == level_size
+            for (i, j, k), value in zip(self.leaf_origin[on_level], self.leaf_value[on_level]):
+                values[k:k+level_size+1, j:j+level_size+1, i:i+level_size+1] = value
+        corners = (self.surface_origin[:, None, :] + CORNERS[None, :, :]).reshape(-1, 3)
+        values[corners[:, 2], corners[:, 1], corners[:, 0]] = self.surface_values.ravel()
+        G = Grid(list(self.m_min_coord), list(self.m_max_coord), n, n, n,
+                 values=values.reshape(-1, 1), phi=self.phi)
+        return G
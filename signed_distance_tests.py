@@ -4,6 +4,7 @@ import distmesh as dm
 import numpy as np
 from signed_distance_factory import Grid, sphere, cylinder, box, union, intersection, difference,\
                                     translate, scale, rotate, erosion, dilation, opening
+from signed_distance_octree import Octree
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
 from skimage import measure
@@ -159,4 +160,43 @@ print([G[0,0,0] , G[0,0,4]])
 print(np.min(G.values))
 print("Test 13 (Dilation b):", test_text(all([G[0,0,0] == [-4.0], G[0,0,4] == [0.0]]) and before))
 
+# Test 14: Sampling (trilinear interpolation is exact on lattice nodes and for linear fields)
+G_linear = Grid(min_coord, max_coord, gran, gran, gran)
+G_linear.create(lambda x: x[..., 0] + 2 * x[..., 1] - x[..., 2])
+points = np.array([[0.,0.,0.], [0.25,0.5,-1.75], [-9.9,3.3,7.1]])
+samples = G_linear.sample(points)
+outside = G_linear.sample([[11.,0.,0.]], outside='nan')
+print("Test 14 (Sampling):",
+      test_text(np.allclose(samples, points[:, 0] + 2 * points[:, 1] - points[:, 2])
+                and np.isnan(outside[0])))
+
+# Test 15: Narrow band (same values as a dense grid, clamped to the band)
+G_dense = Grid(min_coord, max_coord, gran, gran, gran)
+G_dense.create(sphere(4))
+G_band = Grid(min_coord, max_coord, gran, gran, gran, band=1.0)
+G_band.create(sphere(4))
+print("Test 15 (Narrow band):",
+      test_text(np.array_equal(np.clip(G_dense.values, -1.0, 1.0), G_band.to_dense())
+                and G_band[0,0,0] == [-1.0] and G_band[0,0,4] == [0.0]))
+
+# Test 16: Octree (same signs as a dense grid with far fewer evaluations)
+O = Octree(min_coord, max_coord, 5)
+O.create(sphere(4))
+G_dense = Grid(min_coord, max_coord, 33, 33, 33)
+G_dense.create(sphere(4))
+print("Test 16 (Octree):",
+      test_text(np.array_equal(np.sign(O.to_grid().values), np.sign(G_dense.values))
+                and O.evaluations < 33**3))
+
+# Test 17: Parallel creation (the same values as a serial one). Guarded, as
+# worker processes may import this script.
+if __name__ == '__main__':
+    phi = difference(Grid(min_coord, max_coord, gran, gran, gran, phi=box(4,4,4)),
+                     Grid(min_coord, max_coord, gran, gran, gran, phi=sphere(3))).phi
+    G_serial = Grid(min_coord, max_coord, gran, gran, gran)
+    G_serial.create(phi)
+    G_parallel = Grid(min_coord, max_coord, gran, gran, gran)
+    G_parallel.create(phi, workers=3)
+    print("Test 17 (Parallel create):", test_text(np.array_equal(G_serial.values, G_parallel.values)))
+
 p, t = dm.distmeshnd(G.phi, dm.huniform, 0.2, (-1,-1,-1, 1,1,1))
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+import random
+import argparse
+import xml.etree.ElementTree as ET
+
+# Synthetic csg designs of parametric size, used by the benchmarks.
+# A design is 'parts' parts on a grid, united by a single n-ary union. Every
+# part is a balanced tree of boolean operations of the given depth whose
+# leaves are randomly transformed primitives, so a part has 2^depth solids.
+
+def vector(values):
+    return '[{}]'.format(', '.join('{:g}'.format(value) for value in values))
+
+class DesignBuilder:
+    def __init__(self, seed, refining, resolution):
+        self.random = random.Random(seed)
+        self.refining = refining
+        self.resolution = resolution
+        self.root = ET.Element('data')
+        self.count = 0
+
+    def add(self, tag, attrib, children=(), operands=()):
+        name = '{}{}'.format(tag[0], self.count)
+        self.count += 1
+        element = ET.SubElement(self.root, tag, dict(attrib, name=name))
+        for operand in operands:
+            ET.SubElement(element, 'operand').text = operand
+        for child, text in children:
+            ET.SubElement(element, child).text = text
+        return name
+
+    # A random primitive of about unit size, moved and turned about 'center'
+    def primitive(self, center):
+        shape = self.random.choice(['cube', 'sphere', 'cylinder'])
+        if shape == 'cube':
+            size = [self.random.uniform(0.8, 1.6) for _ in range(3)]
+            name = self.add('solid', {'shape': 'cube'}, [('size', vector(size)),
+                                                         ('refining', str(self.refining))])
+        elif shape == 'sphere':
+            name = self.add('solid', {'shape': 'sphere'}, [('center', vector([0, 0, 0])),
+                                                           ('scale', '{:g}'.format(self.random.uniform(0.3, 0.5))),
+                                                           ('refining', str(self.refining + 1))])
+        else:
+            length = self.random.uniform(0.5, 1.0)
+            name = self.add('solid', {'shape': 'cylinder'}, [('start', vector([0, -length, 0])),
+                                                             ('end', vector([0, length, 0])),
+                                                             ('radius', '{:g}'.format(self.random.uniform(0.2, 0.5))),
+                                                             ('resolution', str(self.resolution))])
+        rotation = self.add('unary_op', {'type': self.random.choice(['rotateX', 'rotateY', 'rotateZ'])},
+                            [('rotation', '{:g}'.format(self.random.uniform(0, 90)))], [name])
+        offset = [c + self.random.uniform(-0.4, 0.4) for c in center]
+        return self.add('unary_op', {'type': 'translate'}, [('distance', vector(offset))], [rotation])
+
+    def part(self, center, depth):
+        if depth == 0:
+            return self.primitive(center)
+        left = self.part(center, depth - 1)
+        right = self.part(center, depth - 1)
+        op = self.random.choice(['union', 'union', 'difference'])
+        return self.add('binary_op', {'type': op}, operands=[left, right])
+
+'''
+Builds a synthetic design.
+
+@param parts: Number of parts
+@param depth: Depth of the boolean tree of every part
+@param seed: Seed of the random shapes
+@param spacing: Distance between the centers of neighbouring parts. Parts
+                about 1.5 apart touch their neighbours, parts 3 apart are separated.
+@param refining: refining of the cubes (the spheres get one more)
+@param resolution: resolution of the cylinders
+@return: root element of the design
+'''
+def make_design(parts=8, depth=2, seed=0, spacing=1.5, refining=1, resolution=16):
+    builder = DesignBuilder(seed, refining, resolution)
+    side = max(1, int(round(parts ** (1. / 3.))))
+    names = []
+    for p in range(parts):
+        center = [spacing * (p % side), spacing * ((p // side) % side), spacing * (p // (side * side))]
+        names.append(builder.part(center, depth))
+    if len(names) > 1:
+        builder.add('binary_op', {'type': 'union'}, operands=names)
+    return builder.root
+
+def write_design(fname, **kwargs):
+    ET.ElementTree(make_design(**kwargs)).write(fname)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic csg xml design')
+    parser.add_argument('filename')
+    parser.add_argument('--parts', type=int, default=8, help='Number of parts')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of the boolean tree of every part')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spacing', type=float, default=1.5,
+                        help='Distance between neighbouring parts (3 separates them)')
+    parser.add_argument('--refining', type=int, default=1)
+    parser.add_argument('--resolution', type=int, default=16)
+    args = parser.parse_args()
+    write_design(args.filename, parts=args.parts, depth=args.depth, seed=args.seed,
+                 spacing=args.spacing, refining=args.refining, resolution=args.resolution)
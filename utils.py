@@ -1,110 +1,168 @@
-import sys
 import numpy as np
-from stl import mesh
 
-# Add pyigl to the path
-PATH_TO_LIBIGL = '/home/max/diku/2018/project2018b2/SoftRoboticDesign/robot_designs/libigl/python'
-sys.path.insert(0, PATH_TO_LIBIGL)
-import pyigl as igl
+# Record layout of a binary STL triangle: normal, three vertices, attribute byte count
+STL_DTYPE = np.dtype([('normals', '<f4', (3,)),
+                      ('vectors', '<f4', (3, 3)),
+                      ('attr', '<u2', (1,))])
 
 '''
-Save a model given as vertices and faces as an .stl file.
+Save a model given as vertices and faces as a binary .stl file.
+The triangles are written in chunks, so only chunk_size triangles are ever
+copied at once.
 
-@param fname: Filename to save it to
+@param fname: Filename (or binary file handle) to save it to
 @param V: Vertices of the model
 @param F: Faces of the model
+@param chunk_size: Number of triangles converted and written at a time
 '''
-def save_to_stl(fname, V, F):
-    solid = mesh.Mesh(np.zeros(F.shape[0], dtype=mesh.Mesh.dtype))
-    for i,f in enumerate(F):
-        for j in range(3):
-            solid.vectors[i][j] = V[f[j], :]
-    solid.save(fname)
+def save_to_stl(fname, V, F, chunk_size=1 << 16):
+    if not hasattr(fname, 'write'):
+        with open(fname, 'wb') as fh:
+            save_to_stl(fh, V, F, chunk_size)
+        return
+    V = np.asarray(V, dtype=np.float64)
+    F = np.asarray(F)
+    header = b'pyXCSG binary STL'
+    fname.write(header.ljust(80, b' '))
+    fname.write(np.array(F.shape[0], dtype='<u4').tobytes())
+    for start in range(0, F.shape[0], chunk_size):
+        triangles = V[F[start:start+chunk_size]]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        lengths = np.linalg.norm(normals, axis=1)
+        # Degenerate triangles get a zero normal
+        normals /= np.where(lengths > 0, lengths, 1.0)[:, None]
+        records = np.zeros(triangles.shape[0], dtype=STL_DTYPE)
+        records['normals'] = normals
+        records['vectors'] = triangles
+        fname.write(records.tobytes())
+
+'''
+4x4 affine matrix translating by dist.
+
+@param dist: distances [distX, distY, distZ]
+@return: 4x4 transformation matrix
+'''
+def translation_matrix(dist):
+    M = np.eye(4)
+    M[:3, 3] = dist
+    return M
+
+'''
+4x4 affine matrix rotating about the axis parallel to 'axis' through 'center'.
+
+@param axis: 0, 1 or 2 for the X-, Y- or Z-axis
+@param rotation: radians to rotate
+@param center: point (x, y, z) the rotation is about
+@return: 4x4 transformation matrix
+'''
+def rotation_matrix(axis, rotation, center=(0., 0., 0.)):
+    c, s = np.cos(rotation), np.sin(rotation)
+    # The two coordinates that change, in the order they are rotated
+    u, v = [(1, 2), (2, 0), (0, 1)][axis]
+    R = np.eye(4)
+    R[u, u], R[u, v] = c, -s
+    R[v, u], R[v, v] = s, c
+    return translation_matrix(center) @ R @ translation_matrix(-np.asarray(center, dtype=np.float64))
+
+'''
+4x4 affine matrix scaling about the origin.
+
+@param scale: scaling factor, either a scalar or [scaleX, scaleY, scaleZ]
+@return: 4x4 transformation matrix
+'''
+def scale_matrix(scale):
+    M = np.eye(4)
+    M[:3, :3] *= np.broadcast_to(np.asarray(scale, dtype=np.float64), (3,))
+    return M
+
+'''
+Apply a 4x4 affine matrix to vertices with a single matmul.
+
+@param V: Vertices (n x 3), or a single point (3,)
+@param M: 4x4 transformation matrix
+@return: Transformed vertices (as np.array)
+'''
+def apply_transform(V, M):
+    return np.asarray(V, dtype=np.float64) @ M[:3, :3].T + M[:3, 3]
 
 '''
 Translate vertices V by dist.
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param dist: distances [distX, distY, distZ]
-@return: Translated vertices (as igl.eigen.MatrixXd)
+@return: Translated vertices (as np.array)
 '''
 def translate(V, dist):
-    return igl.eigen.MatrixXd(np.array(V) + dist)
+    return np.asarray(V, dtype=np.float64) + dist
 
 '''
 Rotates vertices V around its own center in the X-axis direction.
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param rotation: radians to rotate
-@return: Rotated vertices (as igl.eigen.MatrixXd)
+@return: Rotated vertices (as np.array)
 '''
 def rotateX(V, rotation):
-    V_rotated = []
-    centerx, centery, centerz = np.mean(np.array(V), axis=0)
-    for v in np.array(V):
-        x, y, z = v
-        yr = ((y - centery) * np.cos(rotation) - (z - centerz) * np.sin(rotation)) + centery
-        zr = ((y - centery) * np.sin(rotation) + (z - centerz) * np.cos(rotation)) + centerz
-        V_rotated.append([x, yr, zr])
-    return igl.eigen.MatrixXd(np.array(V_rotated))
+    V = np.asarray(V, dtype=np.float64)
+    return apply_transform(V, rotation_matrix(0, rotation, np.mean(V, axis=0)))
 
 '''
-Rotates vertices V around its own center in the X-axis direction.
+Rotates vertices V around its own center in the Y-axis direction.
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param rotation: radians to rotate
-@return: Rotated vertices (as igl.eigen.MatrixXd)
+@return: Rotated vertices (as np.array)
 '''
 def rotateY(V, rotation):
-    V_rotated = []
-    centerx, centery, centerz = np.mean(np.array(V), axis=0)
-    for v in np.array(V):
-        x, y, z = v
-        zr = ((z - centerz) * np.cos(rotation) - (x - centerx) * np.sin(rotation)) + centerz
-        xr = ((z - centerz) * np.sin(rotation) + (x - centerx) * np.cos(rotation)) + centerx
-        V_rotated.append([xr, y, zr])
-    return igl.eigen.MatrixXd(np.array(V_rotated))
+    V = np.asarray(V, dtype=np.float64)
+    return apply_transform(V, rotation_matrix(1, rotation, np.mean(V, axis=0)))
 
 '''
-Rotates vertices V around its own center in the X-axis direction.
+Rotates vertices V around its own center in the Z-axis direction.
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param rotation: radians to rotate
-@return: Rotated vertices (as igl.eigen.MatrixXd)
+@return: Rotated vertices (as np.array)
 '''
 def rotateZ(V, rotation):
-    V_rotated = []
-    centerx, centery, centerz = np.mean(np.array(V), axis=0)
-    for v in np.array(V):
-        x, y, z = v
-        xr = ((x - centerx) * np.cos(rotation) - (y - centery) * np.sin(rotation)) + centerx
-        yr = ((x - centerx) * np.sin(rotation) + (y - centery) * np.cos(rotation)) + centery
-        V_rotated.append([xr, yr, z])
-    return igl.eigen.MatrixXd(np.array(V_rotated))
+    V = np.asarray(V, dtype=np.float64)
+    return apply_transform(V, rotation_matrix(2, rotation, np.mean(V, axis=0)))
 
 '''
 Scale vertices V by 'scale'
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param scale: scaling factor
-@return: Scaled vertices (as igl.eigen.MatrixXd)
+@return: Scaled vertices (as np.array)
 '''
 def scale(V, scale):
-    return igl.eigen.MatrixXd(np.array(V) * scale)
+    return np.asarray(V, dtype=np.float64) * scale
 
 '''
-Scale vertices of a rectangels V by 'scale' in the xz-direction
+Scale vertices of a rectangels V by 'scale' in the xz-direction.
+The vertices are picked by their place in the bounding box: those on the two
+vertical edges at (x_min, z_min) and (x_max, z_max) are scaled, those on the
+other two are kept, and the vertices between them (like the midpoints of a
+refined cuboid) are moved linearly in between, over the xz-rectangle split
+along its diagonal between the scaled edges. For an unrefined cuboid this
+scales its corners 1, 3, 4 and 6.
 
-@param V: Vertices (as igl.eigen.MatrixXd)
+@param V: Vertices (as np.array)
 @param scale: scaling factor
-@return: Scaled vertices (as igl.eigen.MatrixXd)
+@return: Scaled vertices (as np.array)
 '''
 def scaleRectangleXZ(V, scale):
-    V_scaled = []
-    xy = [1, 3, 4, 6]
-    for i, v in enumerate(np.array(V)):
-        if i in xy:
-            V_scaled.append(v * scale)
-        else:
-            V_scaled.append(v)
-    return igl.eigen.MatrixXd(np.array(V_scaled))
+    V = np.array(V, dtype=np.float64).reshape(-1, 3)
+    if len(V) == 0:
+        return V
+    v_min, v_max = V.min(axis=0), V.max(axis=0)
+    # Place of the vertices in the xz-rectangle of the bounding box, in [0, 1]
+    U = (V - v_min) / np.where(v_max > v_min, v_max - v_min, 1.0)
+    u, w = U[:, 0], U[:, 2]
+    # How much the vertices follow the edge at (x_min, z_min) and the one at (x_max, z_max)
+    near = 1.0 - np.maximum(u, w)
+    far = np.minimum(u, w)
+    edge_min = np.column_stack([np.full(len(V), v_min[0]), V[:, 1], np.full(len(V), v_min[2])])
+    edge_max = np.column_stack([np.full(len(V), v_max[0]), V[:, 1], np.full(len(V), v_max[2])])
+    displacement = near[:, None] * edge_min + far[:, None] * edge_max
+    return V + displacement * (np.asarray(scale, dtype=np.float64) - 1.0)